@@ -0,0 +1,195 @@
+import argparse
+import contextlib
+import glob
+import importlib
+import io
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+
+
+# model of every method: (module, class, keyword arguments of its template_matching)
+METHODS = {
+    'traffic_sign_model': ('traffic_sign_model', 'Traffic_sign_model', {'threshold': .6, 'show': False}),
+    'method_0':           ('method_0', 'method_1', {'threshold': .4, 'show': False}),
+    'method_1':           ('method_1', 'method_1', {'threshold': .35, 'show': False}),
+    'method_2':           ('method_2', 'method_2', {'show': False}),
+    'method_3':           ('method_3', 'TemplateMatching', {'threshold': .50, 'show': False}),
+}
+
+STAGES = ['color_segmentation', 'morph_transformation', 'ccl_generation_filtering', 'get_ccl_bbox',
+          'template_matching', 'remove_overlapped']
+
+RESOLUTIONS = [(407, 309), (814, 618), (1628, 1236)]   # (width, height), 1/4, 1/2 and full size of the train images
+
+
+def synthetic_image(width, height, seed=0):
+    """
+    BGR image with red and blue circles, triangles and squares (some with a white interior, like the signs) over a
+    textured background. The same seed gives the same image.
+    """
+    rng = np.random.RandomState(seed)
+    im = rng.randint(60, 140, size=(height, width, 3)).astype(np.uint8)
+    im = cv2.GaussianBlur(im, (5, 5), 0)
+
+    colors = [(40, 40, 200), (200, 80, 30)]   # red, blue
+    for _ in range(8):
+        size = int(rng.uniform(0.03, 0.12) * min(width, height))
+        x, y = int(rng.randint(size, width - size)), int(rng.randint(size, height - size))
+        color = colors[rng.randint(2)]
+        shape = rng.randint(3)
+        if shape == 0:
+            cv2.circle(im, (x, y), size, color, -1)
+            if rng.rand() < 0.5:
+                cv2.circle(im, (x, y), int(size * 0.7), (240, 240, 240), -1)
+        elif shape == 1:
+            triangle = np.array([[x, y - size], [x - size, y + size], [x + size, y + size]], dtype=np.int32)
+            cv2.fillPoly(im, [triangle], color)
+        else:
+            cv2.rectangle(im, (x - size, y - size), (x + size, y + size), color, -1)
+    return im
+
+
+def benchmark_images(resolutions=RESOLUTIONS, samples_dir='./train/', n_samples=2, seed=0):
+    """
+    :return: [(name, image), ...] with a synthetic image and the sample images (if samples_dir exists) at every
+             resolution
+    """
+    images = []
+    samples = [(filename.split('/')[-1][:-4], cv2.imread(filename))
+               for filename in sorted(glob.glob(samples_dir + '*.jpg'))[:n_samples]]
+
+    for width, height in resolutions:
+        images.append(('synthetic_{}'.format(seed), synthetic_image(width, height, seed)))
+        for name, sample in samples:
+            images.append((name, cv2.resize(sample, (width, height), interpolation=cv2.INTER_AREA)))
+    return images
+
+
+def measure(function, make_arguments, repeats):
+    """
+    Times function(*make_arguments()) (the arguments are built out of the timed region) and measures the memory it
+    allocates with tracemalloc in a separate, untimed, call.
+    :return: dict with the median, p95 and min time (seconds) and the peak and retained allocated bytes
+    """
+    quiet = io.StringIO()   # some stages print for every region
+
+    with contextlib.redirect_stdout(quiet):
+        function(*make_arguments())   # warm up (templates, lookup tables...)
+
+        times = []
+        for _ in range(repeats):
+            arguments = make_arguments()
+            t1 = time.perf_counter()
+            function(*arguments)
+            times.append(time.perf_counter() - t1)
+
+        arguments = make_arguments()
+        tracemalloc.start()
+        result = function(*arguments)
+        retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+
+    return {'median_s': float(np.median(times)),
+            'p95_s': float(np.percentile(times, 95)),
+            'min_s': float(np.min(times)),
+            'peak_bytes': int(peak_bytes),
+            'retained_bytes': int(retained_bytes)}
+
+
+def overlapping_windows(window_candidates, seed=0):
+    """
+    Windows and scores for remove_overlapped: every window plus a shifted copy that overlaps it
+    """
+    rng = np.random.RandomState(seed)
+    windows = []
+    for tly, tlx, bry, brx in window_candidates:
+        shift = int(0.2 * (bry - tly))
+        windows.append([tly, tlx, bry, brx])
+        windows.append([tly + shift, tlx + shift, bry + shift, brx + shift])
+    return windows, rng.uniform(0, 1, len(windows)).tolist()
+
+
+def benchmark_method(method, images, repeats=10, stages=STAGES):
+    """
+    Times every stage of a method on every image. The input of every stage is the output of the previous ones.
+    :return: list of results (dicts)
+    """
+    module_name, class_name, template_matching_args = METHODS[method]
+    model = getattr(importlib.import_module(module_name), class_name)()
+
+    results = []
+    for name, im in images:
+        with contextlib.redirect_stdout(io.StringIO()):
+            color_segmentation_mask = model.color_segmentation(im)
+            morph_mask = model.morph_transformation(color_segmentation_mask)
+            pixel_candidates = model.ccl_generation_filtering(morph_mask.copy())
+            window_candidates = model.get_ccl_bbox(pixel_candidates.copy())
+        windows, scores = overlapping_windows(window_candidates)
+
+        # the stages that draw on their inputs get a copy in every call
+        stage_calls = {
+            'color_segmentation':       (model.color_segmentation, lambda: (im,)),
+            'morph_transformation':     (model.morph_transformation, lambda: (color_segmentation_mask,)),
+            'ccl_generation_filtering': (model.ccl_generation_filtering, lambda: (morph_mask.copy(),)),
+            'get_ccl_bbox':             (model.get_ccl_bbox, lambda: (pixel_candidates.copy(),)),
+            'template_matching':        (lambda im_, mask: model.template_matching(im_, mask, **template_matching_args),
+                                         lambda: (im.copy(), pixel_candidates.copy())),
+            'remove_overlapped':        (model.remove_overlapped,
+                                         lambda: ([list(window) for window in windows], list(scores))),
+        }
+
+        for stage in stages:
+            function, make_arguments = stage_calls[stage]
+            result = {'method': method, 'stage': stage, 'image': name, 'width': im.shape[1], 'height': im.shape[0],
+                      'regions': len(window_candidates), 'repeats': repeats}
+            result.update(measure(function, make_arguments, repeats))
+            results.append(result)
+            print('{:20} {:26} {:14} {:>5}x{:<5} median {:9.2f} ms  p95 {:9.2f} ms  peak {:8.1f} MB'.format(
+                method, stage, name, result['width'], result['height'], result['median_s'] * 1000,
+                result['p95_s'] * 1000, result['peak_bytes'] / 2 ** 20))
+    return results
+
+
+def run(methods=None, stages=STAGES, resolutions=RESOLUTIONS, samples_dir='./train/', n_samples=2, repeats=10,
+        output='benchmark.json'):
+    """
+    Runs the benchmark and writes the results as JSON:
+        {"environment": {...}, "results": [{"method", "stage", "image", "width", "height", "regions", "repeats",
+                                           "median_s", "p95_s", "min_s", "peak_bytes", "retained_bytes"}, ...]}
+    :param methods: names of METHODS to benchmark (all of them if None)
+    """
+    images = benchmark_images(resolutions, samples_dir, n_samples)
+
+    results = []
+    for method in (methods or list(METHODS)):
+        results.extend(benchmark_method(method, images, repeats, stages))
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'opencv': cv2.__version__,
+                              'platform': platform.platform(),
+                              'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results': results}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-methods', type=str, nargs='+', default=None, help='Methods to benchmark: '
+                                                                            + ' '.join(METHODS))
+    parser.add_argument('-stages', type=str, nargs='+', default=STAGES, help='Stages to benchmark')
+    parser.add_argument('-samples_dir', type=str, default="./train/", help='Directory with sample images')
+    parser.add_argument('-n_samples', type=int, default=2, help='Number of sample images')
+    parser.add_argument('-repeats', type=int, default=10, help='Timed calls of every stage')
+    parser.add_argument('-output', type=str, default="benchmark.json", help='JSON file with the results')
+    args = parser.parse_args()
+    run(methods=args.methods, stages=args.stages, samples_dir=args.samples_dir, n_samples=args.n_samples,
+        repeats=args.repeats, output=args.output)
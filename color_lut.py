@@ -0,0 +1,53 @@
+import cv2
+import numpy as np
+
+
+class ColorLUT():
+    """
+    BGR -> mask lookup table for the HSV color segmentation.
+
+    All the 256^3 BGR colors are converted to HSV once and tested against the color ranges, so segmenting an image
+    becomes a single indexing pass over the table instead of cvtColor + inRange + bitwise_or per image. The result is
+    bit-identical to the inRange path because cvtColor is a per-pixel operation. The table is bit-packed (2 MB).
+    """
+    def __init__(self, color_ranges):
+        """
+        :param color_ranges: list of (low, high) HSV bounds, e.g. [(blue_low, blue_high), (red_1_low, red_1_high), ...]
+        """
+        self.color_ranges = [(np.array(low, dtype='uint8'), np.array(high, dtype='uint8'))
+                             for low, high in color_ranges]
+        self.table = self.build_table(self.color_ranges)
+
+    @staticmethod
+    def build_table(color_ranges):
+        # every BGR color as a 4096x4096 image, the index of a color is (b << 16) | (g << 8) | r
+        colors = np.arange(1 << 24, dtype=np.uint32)
+        all_colors = np.empty((1 << 24, 3), dtype=np.uint8)
+        all_colors[:, 0] = colors >> 16
+        all_colors[:, 1] = (colors >> 8) & 255
+        all_colors[:, 2] = colors & 255
+        all_colors = all_colors.reshape(4096, 4096, 3)
+
+        hsv_colors = cv2.cvtColor(all_colors, cv2.COLOR_BGR2HSV)
+
+        mask = np.zeros(all_colors.shape[:2], dtype=np.uint8)
+        for low, high in color_ranges:
+            mask = cv2.bitwise_or(mask, cv2.inRange(hsv_colors, low, high))
+
+        return np.packbits(mask.ravel() > 0)
+
+    def segment(self, im):
+        """
+        Color segmentation of the image through the lookup table
+        :param im: BGR image
+        :return: mask with the color segmentation (0 or 255, like cv2.inRange)
+        """
+        index = im[:, :, 0].astype(np.uint32) << 16
+        index |= im[:, :, 1].astype(np.uint32) << 8
+        index |= im[:, :, 2]
+
+        bits = self.table[index >> 3]
+        bits >>= (7 - (index & 7)).astype(np.uint8)
+        bits &= 1
+
+        return bits * np.uint8(255)
@@ -1,18 +1,67 @@
+import hashlib
 import pickle
 import os
+import cv2
+import imageio
+import numpy as np
 import matplotlib.pyplot as plt
 
+from traffic_signs.evaluation.rle_mask import RLEMask
+from traffic_signs.evaluation.packed_mask import PackedMask
+
 
 # note that now the bbox and the sign type are stored as a tuple in a list called annotations. This makes iterating
 # over the annotations easier
 
 
+# memory maps of the store files opened by this process ({filename: np.memmap}), shared by the views of all the
+# instances
+store_maps = {}
+
+
+def map_store(filename, dtype):
+    store_map = store_maps.get(filename)
+    if store_map is None:
+        store_map = np.memmap(filename, dtype=dtype, mode='c')
+        store_maps[filename] = store_map
+    return store_map
+
+
 class Instance():
     def __init__(self, img_, msk_, img_id_):
         self.img = img_            # numpy array  ==> rgb
         self.msk = msk_            # numpy array  ==> binary image 0 or 1
         self.annotations = []      # [ ([tly, tlx, bry, brx], sign_type), ... ]
         self.img_id = img_id_      # srting
+        self.img_view = None       # decoded bgr image (memory-mapped), set by Data_handler.materialize
+        self.msk_view = None       # decoded boolean mask (memory-mapped), set by Data_handler.materialize
+        self.msk_rle  = None       # run-length encoded mask (RLEMask), set by Data_handler.encode_masks_rle
+        self.msk_packed = None     # bit-packed mask (PackedMask), set by Data_handler.pack_masks
+        self.store = None          # (split_dir, image_offset, image_shape, mask_offset, mask_shape) of the views
+
+    def __getstate__(self):
+        # the views are not pickled (that would copy the decoded image and mask, e.g. to every task of a process
+        # pool), the unpickled instance maps them again from the store
+        state = self.__dict__.copy()
+        state['img_view'] = None
+        state['msk_view'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, 'store', None) is not None:
+            self.map_views()
+
+    def map_views(self):
+        """
+        Sets img_view and msk_view from the memory maps of the store (opened once per process)
+        """
+        split_dir, image_offset, image_shape, mask_offset, mask_shape = self.store
+        images = map_store(split_dir + "images.bin", np.uint8)
+        self.img_view = images[image_offset:image_offset + int(np.prod(image_shape))].reshape(image_shape)
+        if mask_shape is not None:
+            masks = map_store(split_dir + "masks.bin", np.bool_)
+            self.msk_view = masks[mask_offset:mask_offset + int(np.prod(mask_shape))].reshape(mask_shape)
 
 
 class Data_handler():
@@ -77,6 +126,103 @@ class Data_handler():
 
         return self.train_set, self.valid_set, self.test_set
 
+    def materialize(self, split='train', store_dir='./store/'):
+        """
+        Decodes once all the images (and masks) of a split into two flat files that are memory-mapped afterwards, so
+        the instances of the split expose zero-copy views (instance.img_view, instance.msk_view) instead of being
+        decoded again on every pass. If the store of the split already exists it is reused: the store directory is
+        named after the split and a hash of the paths of its images, so a split of another dataset (another train_dir,
+        other ids) gets its own store.
+        The views are copy-on-write: drawing on them does not modify the store. They are not pickled with the
+        instances, an unpickled instance (e.g. in a worker process) maps them again from the store.
+        :param split: can be one of the following: 'test', 'val', 'train'
+        :param store_dir: directory of the store
+        :return: the instances of the split
+        """
+        instances = {'train': self.train_set, 'val': self.valid_set, 'test': self.test_set}[split]
+        if not instances:
+            return instances   # np.memmap can not map an empty file
+
+        paths = "\n".join(os.path.abspath(instance.img) for instance in instances)
+        split_dir    = os.path.abspath(store_dir + split + "_" + hashlib.md5(paths.encode()).hexdigest()[:16]) + "/"
+        index_file   = split_dir + "index.pkl"
+
+        if not os.path.exists(index_file):
+            self.write_store(instances, split_dir)
+            store_maps.pop(split_dir + "images.bin", None)
+            store_maps.pop(split_dir + "masks.bin", None)
+
+        with open(index_file, "rb") as f:
+            index = pickle.load(f)      # {id: (image_offset, image_shape, mask_offset, mask_shape)}
+
+        for instance in instances:
+            instance.store = (split_dir,) + tuple(index[instance.img_id])
+            instance.map_views()
+
+        return instances
+
+    def encode_masks_rle(self, split='train'):
+        """
+        Keeps the ground truth masks of a split run-length encoded (instance.msk_rle), a few KB per image. The
+        evaluation then computes the pixel metrics from the runs.
+        :param split: can be one of the following: 'val', 'train'
+        :return: the instances of the split
+        """
+        instances = {'train': self.train_set, 'val': self.valid_set}[split]
+
+        for instance in instances:
+            if instance.msk_view is not None:
+                instance.msk_rle = RLEMask.from_dense(instance.msk_view)
+            else:
+                instance.msk_rle = RLEMask.from_png(instance.msk)
+
+        return instances
+
+    def pack_masks(self, split='train'):
+        """
+        Keeps the ground truth masks of a split bit-packed (instance.msk_packed), one bit per pixel. The evaluation
+        then computes the pixel metrics with popcounts of the packed masks.
+        :param split: can be one of the following: 'val', 'train'
+        :return: the instances of the split
+        """
+        instances = {'train': self.train_set, 'val': self.valid_set}[split]
+
+        for instance in instances:
+            if instance.msk_view is not None:
+                instance.msk_packed = PackedMask.from_dense(instance.msk_view)
+            else:
+                instance.msk_packed = PackedMask.from_dense(imageio.imread(instance.msk))
+
+        return instances
+
+    @staticmethod
+    def write_store(instances, split_dir):
+        if not os.path.exists(split_dir):
+            os.makedirs(split_dir)
+
+        index = {}
+        image_offset = 0
+        mask_offset  = 0
+        with open(split_dir + "images.bin", "wb") as images_f, open(split_dir + "masks.bin", "wb") as masks_f:
+            for instance in instances:
+                image = cv2.imread(instance.img)
+                image.tofile(images_f)
+
+                mask_shape = None
+                if instance.msk is not None:
+                    mask = imageio.imread(instance.msk) > 0
+                    mask.tofile(masks_f)
+                    mask_shape = mask.shape
+
+                index[instance.img_id] = (image_offset, image.shape, mask_offset, mask_shape)
+                image_offset += image.size
+                if mask_shape is not None:
+                    mask_offset += mask.size
+
+        # the index is written last, so an interrupted store is written again the next time
+        with open(split_dir + "index.pkl", "wb") as f:
+            pickle.dump(index, f)
+
     @staticmethod
     def parse_sign_type(sign_type):
         if sign_type == 'A':
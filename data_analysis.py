@@ -3,6 +3,7 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 import cv2
 from data import Data_handler
+from integral_image import IntegralImage
 import os
 import numpy as np
 
@@ -87,15 +88,15 @@ class Data_analysis():
 
         for image in train_split:
             mask = plt.imread(image.msk)
-            for ann in image.annotations:
+
+            # pixel count of all the annotations of the image at once
+            bboxes = np.array([[int(value) for value in ann[0][:4]] for ann in image.annotations]).reshape(-1, 4)
+            pixel_counts = IntegralImage((mask > 0).astype(np.uint8)).sum_rectangles(bboxes)
+
+            for ann, pixel_count in zip(image.annotations, pixel_counts):
                 bbox = ann[0]
 
                 # filling ratio
-                pixel_count = 0
-                for x in range(int(bbox[0]), int(bbox[2])):
-                    for y in range(int(bbox[1]), int(bbox[3])):
-                        if mask[x, y]:
-                            pixel_count += 1
                 filling_ratio = pixel_count / ((int(bbox[2]) - int(bbox[0])) * (int(bbox[3]) - int(bbox[1])))
                 filling_ratios[ann[1]].append(filling_ratio)
 
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+
+
+FLT_EPSILON = np.finfo(np.float32).eps
+DBL_EPSILON = np.finfo(np.float64).eps
+
+
+def match_templates_ccoeff_normed(image, templates, means=None, norms=None, batch_size=8):
+    """
+    Same maps as cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED) for a stack of templates of the same size.
+    The image is transformed to the frequency domain once and correlated with a whole batch of templates in a single
+    FFT pass, instead of one spatial correlation per template.
+    :param image: gray image (2D array)
+    :param templates: array of shape (number of templates, height, width), not larger than the image
+    :param means: mean of every template (computed if None)
+    :param norms: norm of every template minus its mean (computed if None)
+    :param batch_size: number of templates transformed together (bounds the memory of the spectra)
+    :return: float32 array of shape (number of templates, image height - height + 1, image width - width + 1)
+    """
+    image = np.asarray(image, dtype=np.float64)
+    templates = np.asarray(templates, dtype=np.float64)
+    n_templates, t_h, t_w = templates.shape
+    im_h, im_w = image.shape
+
+    if means is None:
+        means = templates.mean(axis=(1, 2))
+    zero_mean_templates = templates - np.asarray(means, dtype=np.float64)[:, None, None]
+    if norms is None:
+        norms = np.sqrt(np.sum(zero_mean_templates ** 2, axis=(1, 2)))
+
+    # the circular correlation only wraps into the first t_h-1 rows and t_w-1 columns, which are not used
+    fft_shape = (cv2.getOptimalDFTSize(im_h), cv2.getOptimalDFTSize(im_w))
+    image_fft = np.fft.rfft2(image, s=fft_shape)
+
+    numerators = np.empty((n_templates, im_h - t_h + 1, im_w - t_w + 1), dtype=np.float64)
+    for start in range(0, n_templates, batch_size):
+        # correlation = convolution with the flipped templates
+        flipped = zero_mean_templates[start:start + batch_size, ::-1, ::-1]
+        correlation = np.fft.irfft2(np.fft.rfft2(flipped, s=fft_shape) * image_fft, s=fft_shape)
+        numerators[start:start + batch_size] = correlation[:, t_h - 1:im_h, t_w - 1:im_w]
+
+    # sum and squared sum of every window of the image
+    window_sum, window_sqsum = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    window_sum = (window_sum[t_h:, t_w:] - window_sum[:-t_h, t_w:] - window_sum[t_h:, :-t_w]
+                  + window_sum[:-t_h, :-t_w])
+    window_sqsum = (window_sqsum[t_h:, t_w:] - window_sqsum[:-t_h, t_w:] - window_sqsum[t_h:, :-t_w]
+                    + window_sqsum[:-t_h, :-t_w])
+
+    # normalization, with the same handling of flat windows as opencv
+    diff2 = np.maximum(window_sqsum - window_sum ** 2 / (t_h * t_w), 0)
+    window_norms = np.where(diff2 <= np.minimum(0.5, 10 * FLT_EPSILON * window_sqsum), 0, np.sqrt(diff2))
+    denominators = window_norms[None] * np.asarray(norms, dtype=np.float64)[:, None, None]
+
+    abs_numerators = np.abs(numerators)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(abs_numerators < denominators, numerators / denominators,
+                          np.where(abs_numerators < denominators * 1.125, np.sign(numerators), 0))
+
+    # opencv gives 1 everywhere for a flat template
+    result[np.asarray(norms, dtype=np.float64) < DBL_EPSILON] = 1
+
+    return result.astype(np.float32)
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+
+class HSVHistogram():
+    """
+    3D HSV histograms of the ground truth positive and negative pixels of a split, stored as cumulative (summed-volume)
+    tables. The number of pixels inside any HSV box is then 8 lookups, so the pixel TP/FP/FN/TN of the color
+    segmentation (before the morphological operations) can be computed for any thresholds without segmenting the images.
+    """
+    H_BINS = 180   # opencv hue of uint8 images is in [0, 180)
+    S_BINS = 256
+    V_BINS = 256
+
+    def __init__(self):
+        self.positives = np.zeros(self.H_BINS * self.S_BINS * self.V_BINS, dtype=np.int64)
+        self.negatives = np.zeros(self.H_BINS * self.S_BINS * self.V_BINS, dtype=np.int64)
+        self.cumulative_positives = None
+        self.cumulative_negatives = None
+
+    def add_image(self, im, pixel_annotation):
+        """
+        Adds the pixels of an image to the histograms
+        :param im: BGR image
+        :param pixel_annotation: ground truth mask of the image
+        """
+        hsv_image = cv2.cvtColor(im, cv2.COLOR_BGR2HSV)
+        bins = (hsv_image[:, :, 0].astype(np.int64) * self.S_BINS + hsv_image[:, :, 1]) * self.V_BINS + hsv_image[:, :, 2]
+        pixel_annotation = np.asarray(pixel_annotation) > 0
+
+        self.positives += np.bincount(bins[pixel_annotation], minlength=self.positives.size)
+        self.negatives += np.bincount(bins[~pixel_annotation], minlength=self.negatives.size)
+
+    def compute_cumulative(self):
+        """
+        Computes the summed-volume tables. They have a leading row of zeros in every axis, so
+        cumulative[h, s, v] is the number of pixels with H < h, S < s and V < v.
+        """
+        self.cumulative_positives = self.summed_volume(self.positives)
+        self.cumulative_negatives = self.summed_volume(self.negatives)
+
+    def summed_volume(self, histogram):
+        cumulative = np.zeros((self.H_BINS + 1, self.S_BINS + 1, self.V_BINS + 1), dtype=np.int64)
+        cumulative[1:, 1:, 1:] = histogram.reshape(self.H_BINS, self.S_BINS, self.V_BINS)
+        cumulative.cumsum(axis=0, out=cumulative)
+        cumulative.cumsum(axis=1, out=cumulative)
+        cumulative.cumsum(axis=2, out=cumulative)
+        return cumulative
+
+    def box_count(self, cumulative, low, high):
+        # pixels with low <= hsv <= high (both included, like cv2.inRange)
+        h0, s0, v0 = [max(0, int(value)) for value in low]
+        h1 = min(self.H_BINS, int(high[0]) + 1)
+        s1 = min(self.S_BINS, int(high[1]) + 1)
+        v1 = min(self.V_BINS, int(high[2]) + 1)
+        if h0 >= h1 or s0 >= s1 or v0 >= v1:
+            return 0
+
+        return (cumulative[h1, s1, v1] - cumulative[h0, s1, v1] - cumulative[h1, s0, v1] - cumulative[h1, s1, v0]
+                + cumulative[h0, s0, v1] + cumulative[h0, s1, v0] + cumulative[h1, s0, v0] - cumulative[h0, s0, v0])
+
+    def union_count(self, cumulative, color_ranges):
+        # inclusion-exclusion over the boxes, the intersection of boxes is a box
+        count = 0
+        for subset in range(1, 1 << len(color_ranges)):
+            ranges = [color_ranges[i] for i in range(len(color_ranges)) if subset & (1 << i)]
+            low  = np.max([low for low, high in ranges], axis=0)
+            high = np.min([high for low, high in ranges], axis=0)
+            sign = 1 if len(ranges) % 2 else -1
+            count += sign * self.box_count(cumulative, low, high)
+        return count
+
+    def performance_accumulation_pixel(self, color_ranges):
+        """
+        Pixel performance of the color segmentation with the given ranges
+        :param color_ranges: list of (low, high) HSV bounds, e.g. [(blue_low, blue_high), (red_1_low, red_1_high), ...]
+        :return: [pixelTP, pixelFP, pixelFN, pixelTN]
+        """
+        if self.cumulative_positives is None:
+            self.compute_cumulative()
+
+        pixelTP = self.union_count(self.cumulative_positives, color_ranges)
+        pixelFP = self.union_count(self.cumulative_negatives, color_ranges)
+        pixelFN = self.cumulative_positives[-1, -1, -1] - pixelTP
+        pixelTN = self.cumulative_negatives[-1, -1, -1] - pixelFP
+
+        return [pixelTP, pixelFP, pixelFN, pixelTN]
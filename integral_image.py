@@ -3,8 +3,21 @@ import numpy as np
 
 
 class IntegralImage():
-    def __init__(self, image):
-        self.integral_image = cv2.integral(image)[1:,1:]
+    """
+    Integral image (and optionally the integral of the squared image) of a one or multi-channel image.
+    The sum, mean and variance of any number of rectangles are computed in one NumPy gather with the *_rectangles
+    methods. The mean of a binary (0/1) image is the filling ratio of the rectangles.
+    The integrals keep the default depth of cv2.integral (int32 for uint8 images, float64 for float images, float64
+    for the squared integral), so get_integral_image returns the same as before.
+    """
+    def __init__(self, image, squared=False):
+        # the padded integrals have a leading row and column of zeros: padded[y, x] is the sum of image[:y, :x]
+        if squared:
+            self.padded_integral, self.padded_squared_integral = cv2.integral2(image)
+        else:
+            self.padded_integral = cv2.integral(image)
+            self.padded_squared_integral = None
+        self.integral_image = self.padded_integral[1:,1:]
 
 
     def get_integral_image(self):
@@ -19,13 +32,62 @@ class IntegralImage():
     def calculate_value_rectangle(self, A, B, C, D):
         return self.integral_image[D] - self.integral_image[B] - self.integral_image[C] + self.integral_image[A]
 
+    # Format of the boxes is [tly, tlx, bry, brx], where the bottom-right corner is not included (like the windows of
+    # get_ccl_bbox and the slices image[tly:bry, tlx:brx]). Coordinates outside the image are clipped.
+    def box_corners(self, boxes):
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        height, width = self.padded_integral.shape[0] - 1, self.padded_integral.shape[1] - 1
+        tly = np.clip(boxes[:, 0], 0, height).astype(np.intp)
+        tlx = np.clip(boxes[:, 1], 0, width).astype(np.intp)
+        bry = np.clip(boxes[:, 2], 0, height).astype(np.intp)
+        brx = np.clip(boxes[:, 3], 0, width).astype(np.intp)
+        return tly, tlx, bry, brx
 
+    @staticmethod
+    def gather(padded, tly, tlx, bry, brx):
+        return padded[bry, brx] - padded[tly, brx] - padded[bry, tlx] + padded[tly, tlx]
 
-######### Example ############################################################
-snap = np.ones((3,3),dtype='uint8')
-print(snap)
+    def sum_rectangles(self, boxes):
+        """
+        :param boxes: (N, 4) array of [tly, tlx, bry, brx]
+        :return: sum of every box, shape (N,) or (N, channels)
+        """
+        return self.gather(self.padded_integral, *self.box_corners(boxes))
 
-integral_image = IntegralImage(snap)
-print(integral_image.get_integral_image())
-print("---------")
-print(integral_image.calculate_value_rectangle((0, 0), (0, 2), (2, 0), (2, 2)))
+    def area_rectangles(self, boxes):
+        tly, tlx, bry, brx = self.box_corners(boxes)
+        return (bry - tly) * (brx - tlx)
+
+    def mean_rectangles(self, boxes):
+        """
+        :param boxes: (N, 4) array of [tly, tlx, bry, brx]
+        :return: mean of every box (0 for empty boxes), shape (N,) or (N, channels)
+        """
+        sums = self.sum_rectangles(boxes)
+        areas = self.area_rectangles(boxes).reshape((-1,) + (1,) * (sums.ndim - 1))
+        return sums / np.maximum(areas, 1)
+
+    def variance_rectangles(self, boxes):
+        """
+        Needs the squared integral (IntegralImage(image, squared=True))
+        :param boxes: (N, 4) array of [tly, tlx, bry, brx]
+        :return: variance of every box, shape (N,) or (N, channels)
+        """
+        corners = self.box_corners(boxes)
+        sums = self.gather(self.padded_integral, *corners)
+        squared_sums = self.gather(self.padded_squared_integral, *corners)
+        areas = np.maximum(self.area_rectangles(boxes), 1).reshape((-1,) + (1,) * (sums.ndim - 1))
+        means = sums / areas
+        return np.maximum(squared_sums / areas - means ** 2, 0)
+
+
+if __name__ == "__main__":
+    ######### Example ############################################################
+    snap = np.ones((3,3),dtype='uint8')
+    print(snap)
+
+    integral_image = IntegralImage(snap)
+    print(integral_image.get_integral_image())
+    print("---------")
+    print(integral_image.calculate_value_rectangle((0, 0), (0, 2), (2, 0), (2, 2)))
+    print(integral_image.sum_rectangles([[0, 0, 3, 3], [1, 1, 3, 3]]))
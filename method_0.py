@@ -7,6 +7,8 @@ from data_analysis import Data_analysis
 from traffic_signs import traffic_sign_detection as detection
 from traffic_signs.evaluation.bbox_iou import bbox_iou
 from traffic_sign_model import Traffic_sign_model
+from template_bank import get_template_bank
+from traffic_signs.tracing import get_tracer
 import matplotlib.pyplot as plt
 import os
 import time
@@ -45,22 +47,6 @@ class method_1(Traffic_sign_model):
             'red2_high_v': [249, 20, 255],
         }
 
-    def pixel_method(self, im):
-        """
-        Color segmentation of red and blue regions and morphological transformations
-        :param im: BGR image
-        :return: mask with the pixel candidates
-        """
-        
-        
-        color_segmentation_mask = self.color_segmentation(im)
-        pixel_candidates        = self.morph_transformation(color_segmentation_mask)
-        pixel_candidates        = self.ccl_generation_filtering(pixel_candidates)
-        
-        
-        
-        return pixel_candidates
-
     def window_method(self, im, pixel_candidates):
     # Format of the bboxes is [tly, tlx, bry, brx, ...], where tl and br
         #cv2.imshow('o',im)
@@ -90,18 +76,11 @@ class method_1(Traffic_sign_model):
         final_mask = pixel_candidates
         window_candidates = []
         im_h, im_w, _ = im.shape
-        # read the templates
-        templates      = []
-        templates_mask = []
-        template_filenames = os.listdir("./data/templates/")
-
-        for filename in template_filenames:
-            template = cv2.imread("./data/templates/" + filename)
-            template_mask = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-            _,template_mask = cv2.threshold(template_mask,5,255,cv2.THRESH_BINARY)
-            template_mask = cv2.cvtColor(template_mask, cv2.COLOR_GRAY2BGR)
-            templates.append(template)
-            templates_mask.append(template_mask)
+        # the templates are read once per process
+        template_bank  = get_template_bank()
+        templates      = template_bank.bgr
+        templates_mask = template_bank.mask
+        templates_compared = 0
 
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -114,6 +93,7 @@ class method_1(Traffic_sign_model):
                 region = np.copy(im[y:(y+height),x:(x+width), :])
                 region_shape = region.shape
                 region_resized = cv2.resize(region, (100, 100))
+                templates_compared += len(templates)
 
                 for template, template_mask in zip(templates,templates_mask):
                      #= cv2.bitwise_and(region_resized, templates_mask)
@@ -150,5 +130,7 @@ class method_1(Traffic_sign_model):
                     cv2.rectangle(im,(w[1],w[0]),(w[3],w[2]),(0,255,0),3)
                     cv2.imshow('im',im)
             print(min_score)
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
 
         return final_mask, window_candidates
@@ -7,6 +7,9 @@ from data_analysis import Data_analysis
 from traffic_signs import traffic_sign_detection as detection
 from traffic_signs.evaluation.bbox_iou import bbox_iou
 from traffic_sign_model import Traffic_sign_model
+from template_bank import get_template_bank
+from integral_image import IntegralImage
+from traffic_signs.tracing import get_tracer
 import matplotlib.pyplot as plt
 import os
 import time
@@ -44,25 +47,16 @@ class method_1(Traffic_sign_model):
             'red2_high_s': [255, 20, 255],
             'red2_high_v': [249, 20, 255],
         }
-
-    def pixel_method(self, im):
-        """
-        Color segmentation of red and blue regions and morphological transformations
-        :param im: BGR image
-        :return: mask with the pixel candidates
-        """
-        
-        
-        color_segmentation_mask = self.color_segmentation(im)
-        pixel_candidates        = self.morph_transformation(color_segmentation_mask)
-        pixel_candidates        = self.ccl_generation_filtering(pixel_candidates)
-        
-        
-        
-        return pixel_candidates
+        self.sliding_window_mode = 'loop'   # 'loop' or 'integral' (windows scored with integral images, see
+                                            # template_matching_integral)
+        self.top_k_windows       = 5        # windows per region verified with the templates in 'integral' mode
 
     def window_method(self, im, pixel_candidates):
     # Format of the bboxes is [tly, tlx, bry, brx, ...], where tl and br
+        if self.sliding_window_mode == 'integral':
+            final_mask, window_candidates, score_candidates = self.template_matching_integral(im, pixel_candidates, threshold=.35)
+            return self.remove_overlapped(window_candidates, score_candidates)
+
         #cv2.imshow('o',im)
         cv2.imshow('pixel_candidates',pixel_candidates)
         cv2.waitKey(1)
@@ -96,19 +90,12 @@ class method_1(Traffic_sign_model):
         final_mask = pixel_candidates
         window_candidates = []
         im_h, im_w, _ = im.shape
-        # read the templates
-        templates        = []
-        templates_mask   = []
+        # the templates are read once per process
+        template_bank    = get_template_bank()
+        templates        = template_bank.bgr
+        templates_mask   = template_bank.mask
         score_candidates = []
-        template_filenames = os.listdir("./data/templates/")
-
-        for filename in template_filenames:
-            template = cv2.imread("./data/templates/" + filename)
-            template_mask = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-            _,template_mask = cv2.threshold(template_mask,5,255,cv2.THRESH_BINARY)
-            template_mask = cv2.cvtColor(template_mask, cv2.COLOR_GRAY2BGR)
-            templates.append(template)
-            templates_mask.append(template_mask)
+        templates_compared = 0
 
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -129,7 +116,11 @@ class method_1(Traffic_sign_model):
                 region_resized  = cv2.resize(region, (100, 100))
                 sliding_windows = self.sliding_window(region)
                 
-                for template, template_mask in zip(templates,templates_mask):
+                # masks resized to the region (cached by the template bank)
+                resized_masks   = template_bank.resized_mask((region_resized.shape[1], region_resized.shape[0]))
+                templates_compared += len(templates) * len(sliding_windows)
+
+                for template, template_mask in zip(templates,resized_masks):
                     for w in sliding_windows:
                         region = np.copy(im[w[1]:(w[1]+w[3]),w[0]:(w[0]+w[2]), :])
                         #region_resized  = cv2.resize(region, (100, 100))
@@ -139,7 +130,6 @@ class method_1(Traffic_sign_model):
                         #region_resized[template_mask] = 0
                         #print(template_mask.shape  )
                         #print(region_resized.shape )
-                        template_mask = cv2.resize(template_mask, (region_resized.shape[1], region_resized.shape[0]))
                         region_masked = cv2.bitwise_and(region_resized, template_mask)
                         res = cv2.matchTemplate(region_masked, template, cv2.TM_SQDIFF_NORMED)
                         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
@@ -165,6 +155,8 @@ class method_1(Traffic_sign_model):
                             #window_candidates.append([y,x,y+height,x+width])
                             #if show:
                         #print(min_score)
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
 
         return final_mask, window_candidates, score_candidates
 
@@ -184,4 +176,93 @@ class method_1(Traffic_sign_model):
                             slices.append([x,y,w,h])
 
         #slices = [[0,0,im_width,im_height]]
-        return slices
\ No newline at end of file
+        return slices
+
+
+    def sliding_window_array(self, im_width, im_height):
+        """
+        Same windows as sliding_window, generated as an array
+        :return: (N, 4) array of [x, y, w, h]
+        """
+        width_range  = [int(im_width), int(im_width/2), int(im_width/3), int(im_width/4)]
+        x_step       = max(int(im_width/2),2)
+        y_step       = max(int(im_height/5),2)
+
+        windows = [np.zeros((0, 4), dtype=np.int64)]
+        for w in width_range:
+            for h in [w,im_height]:
+                xs, ys = np.meshgrid(np.arange(0, im_width-w+1, x_step), np.arange(0, im_height-h+1, y_step),
+                                     indexing='ij')
+                window = np.empty((xs.size, 4), dtype=np.int64)
+                window[:, 0] = xs.ravel()
+                window[:, 1] = ys.ravel()
+                window[:, 2] = w
+                window[:, 3] = h
+                windows.append(window)
+
+        windows = np.concatenate(windows)
+        return windows[(windows[:, 2] > 0) & (windows[:, 3] > 0)]
+
+    def template_matching_integral(self, im, pixel_candidates, threshold):
+        """
+        Sliding window detection. All the windows of every region (at every scale) are scored at once from integral
+        images of the mask and of the color planes: score = density of candidate pixels * red/blue color ratio. Only the
+        best self.top_k_windows of each region are verified with the templates.
+        :param im: the image (in bgr)
+        :param pixel_candidates: the mask
+        :param threshold: threshold of the template matching score (TM_SQDIFF_NORMED, lower is better)
+        :return: mask, window_candidates, score_candidates
+        """
+        final_mask = pixel_candidates
+        window_candidates = []
+        score_candidates  = []
+        im_h, im_w, _ = im.shape
+
+        template_bank  = get_template_bank()
+        mask_integral  = IntegralImage(np.uint8(pixel_candidates > 0))
+        color_integral = IntegralImage(im)
+        templates_compared = 0
+
+        _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+        for contour in contours:
+            x, y, width, height = cv2.boundingRect(contour)
+            if not (x<im_w and y<im_h and (x+width) < im_w and (y+height)<im_h):
+                continue
+
+            windows = self.sliding_window_array(width, height)
+            if not len(windows):
+                continue
+            # [tly, tlx, bry, brx] in image coordinates
+            boxes = np.stack([windows[:, 1] + y, windows[:, 0] + x,
+                              windows[:, 1] + windows[:, 3] + y, windows[:, 0] + windows[:, 2] + x], axis=1)
+
+            density     = mask_integral.mean_rectangles(boxes)
+            mean_color  = color_integral.mean_rectangles(boxes)
+            color_ratio = np.maximum(mean_color[:, 0], mean_color[:, 2]) / (mean_color.sum(axis=1) + 1)
+            window_scores = density * color_ratio
+
+            best_windows = np.argsort(-window_scores, kind='stable')[:self.top_k_windows]
+
+            for tly, tlx, bry, brx in boxes[best_windows].tolist():
+                min_score = 100000
+                templates_compared += len(template_bank.bgr)
+                # the window is resized once for every template shape (all the templates have the same one)
+                windows_resized = {}
+                for template, template_mask in zip(template_bank.bgr, template_bank.mask):
+                    window_resized = windows_resized.get(template.shape)
+                    if window_resized is None:
+                        window_resized = cv2.resize(im[tly:bry, tlx:brx], (template.shape[1], template.shape[0]))
+                        windows_resized[template.shape] = window_resized
+                    window_masked  = cv2.bitwise_and(window_resized, template_mask)
+                    res = cv2.matchTemplate(window_masked, template, cv2.TM_SQDIFF_NORMED)
+                    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+                    min_score = min(min_score, min_val)
+
+                if min_score<threshold:
+                    window_candidates.append([tly, tlx, bry, brx])
+                    score_candidates.append(min_score)
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
+
+        return final_mask, window_candidates, score_candidates
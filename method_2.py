@@ -1,5 +1,7 @@
 
 from traffic_sign_model import Traffic_sign_model
+from template_bank import get_template_bank
+from traffic_signs.tracing import get_tracer
 import matplotlib.pyplot as plt
 
 import argparse
@@ -47,19 +49,6 @@ class method_2(Traffic_sign_model):
             'threshold_template_matching': [0.5, 0, 1]
         }
 
-    def pixel_method(self, im):
-        """
-        Color segmentation of red and blue regions and morphological transformations
-        :param im: BGR image
-        :return: mask with the pixel candidates
-        """
-
-        color_segmentation_mask = self.color_segmentation(im)
-        pixel_candidates = self.morph_transformation(color_segmentation_mask)
-        pixel_candidates = self.ccl_generation_filtering(pixel_candidates)
-
-        return pixel_candidates
-
     def window_method(self, im, pixel_candidates):
         # Format of the bboxes is [tly, tlx, bry, brx, ...], where tl and br
         # cv2.imshow('o',im)
@@ -89,18 +78,11 @@ class method_2(Traffic_sign_model):
         final_mask = pixel_candidates
         window_candidates = []
         im_h, im_w, _ = im.shape
-        # read the templates
-        templates = []
-        templates_mask = []
-        template_filenames = os.listdir("./data/templates/")
-
-        for filename in template_filenames:
-            template = cv2.imread("./data/templates/" + filename)
-            template_mask = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-            _, template_mask = cv2.threshold(template_mask, 5, 255, cv2.THRESH_BINARY)
-            template_mask = cv2.cvtColor(template_mask, cv2.COLOR_GRAY2BGR)
-            templates.append(template)
-            templates_mask.append(template_mask)
+        # the templates are read once per process
+        template_bank = get_template_bank()
+        templates = template_bank.bgr
+        templates_mask = template_bank.mask
+        templates_compared = 0
 
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -113,6 +95,7 @@ class method_2(Traffic_sign_model):
                 region = np.copy(im[y:(y + height), x:(x + width), :])
                 region_shape = region.shape
                 region_resized = cv2.resize(region, (100, 100))
+                templates_compared += len(templates)
 
                 for template, template_mask in zip(templates, templates_mask):
                     # = cv2.bitwise_and(region_resized, templates_mask)
@@ -139,7 +122,7 @@ class method_2(Traffic_sign_model):
 
                 bottom_right = (top_left[0] + region_shape[1], top_left[1] + region_shape[0])
 
-            if min_score < self.parameters['threshold_template_matching']:
+            if min_score < self.parameters['threshold_template_matching'][0]:
                 window_candidates.append([top_left[1], top_left[0], bottom_right[1], bottom_right[0]])
                 # window_candidates.append([y,x,y+height,x+width])
                 if show:
@@ -147,6 +130,8 @@ class method_2(Traffic_sign_model):
                     cv2.rectangle(im, (w[1], w[0]), (w[3], w[2]), (0, 255, 0), 3)
                     cv2.imshow('im', im)
             #print(min_score)
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
 
         return final_mask, window_candidates
 
@@ -160,7 +145,7 @@ class method_2(Traffic_sign_model):
         for i in range(num_values):
             value = r[0] + (r[1]-r[0])*i/(num_values-1)
             print('Threshold: '+str(value))
-            self.parameters[parameter_name] = value
+            self.parameters[parameter_name][0] = value
             eval = self.evaluate(split='train', output_dir='test_results/')
             precision.append(eval['window_precision'])
             recall.append(eval['window_sensitivity'])
@@ -176,8 +161,9 @@ class method_2(Traffic_sign_model):
 
 
 
-model = method_2()
-model.PRC(parameter_name='threshold_template_matching', num_values=11)
+if __name__ == "__main__":
+    model = method_2()
+    model.PRC(parameter_name='threshold_template_matching', num_values=11)
 
 """fig = plt.plot([1,0.8,0.5,0], [0,0.3,0.6,1])
 #plt.axis([0, 1, 0, 1])
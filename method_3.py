@@ -4,6 +4,10 @@ import cv2
 import numpy as np
 
 from traffic_sign_model import Traffic_sign_model
+from integral_image import IntegralImage
+from template_bank import get_template_bank
+from fft_matching import match_templates_ccoeff_normed
+from traffic_signs.tracing import get_tracer
 
 
 class TemplateMatching(Traffic_sign_model):
@@ -39,13 +43,9 @@ class TemplateMatching(Traffic_sign_model):
         final_mask = pixel_candidates
         window_candidates = []
 
-        # read the templates
-        templates = []
-        template_filenames = os.listdir("./data/templates/")
-        for filename in template_filenames:
-            template = cv2.imread("./data/templates/" + filename)
-            template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY).astype(np.float32)
-            templates.append(template)
+        # the templates are read once per process
+        template_bank = get_template_bank()
+        templates_compared = 0
 
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
         if show:
@@ -78,15 +78,24 @@ class TemplateMatching(Traffic_sign_model):
 
             # print((dsize, dsize), ", ", region.shape)
 
-            for template in templates:
-                for scalar in scalars:
-                    dsize_scaled = int(dsize * scalar)
-                    template_g = cv2.resize(template, dsize=(dsize_scaled, dsize_scaled), interpolation=cv2.INTER_CUBIC)
-                    res = cv2.matchTemplate(region_masked, template_g, cv2.TM_CCOEFF_NORMED)
+            for scalar in scalars:
+                dsize_scaled = int(dsize * scalar)
+                templates_g, means, norms = template_bank.resized_gray(dsize_scaled)
+                templates_compared += len(templates_g)
+                if self.template_matching_engine == 'fft':
+                    # all the templates are correlated with the region in one batched FFT pass
+                    res = match_templates_ccoeff_normed(region_masked, templates_g, means, norms)
                     max_temp_score = np.max(res)
 
                     if max_temp_score > max_score:
                         max_score = max_temp_score
+                else:
+                    for template_g in templates_g:
+                        res = cv2.matchTemplate(region_masked, template_g, cv2.TM_CCOEFF_NORMED)
+                        max_temp_score = np.max(res)
+
+                        if max_temp_score > max_score:
+                            max_score = max_temp_score
             if show:
                 rec = pat.Rectangle((x_min - padding, y_min - padding), (x_max + padding) - (x_min - padding),
                                     (y_max + padding) - (y_min - padding)
@@ -98,6 +107,8 @@ class TemplateMatching(Traffic_sign_model):
                 cv2.fillPoly(pixel_candidates, pts=[contour], color=0)
         if show:
             plt.show()
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
 
         window_candidates = self.get_ccl_bbox(pixel_candidates)
 
@@ -133,15 +144,24 @@ class TemplateMatching(Traffic_sign_model):
 
         image, contours, hierarchy = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
-        for contour in contours:
-            x, y, width, height = cv2.boundingRect(contour)
-
-            pixel_count = 0
-            for x_ in range(x, x+width):
-                for y_ in range(y, y+height):
-                    if pixel_candidates[y_, x_]:
-                        pixel_count += 1
-            filling_ratio = pixel_count / (width * height)
+        bboxes = [cv2.boundingRect(contour) for contour in contours]
+        windows = np.array([[y, x, y + height, x + width] for x, y, width, height in bboxes]).reshape(-1, 4)
+        if self.filling_ratio_mode == 'count':
+            filling_ratios = [None] * len(bboxes)
+        else:
+            # filling ratio of the bounding boxes of all the contours at once, from the mask before the loop
+            filling_ratios = IntegralImage((pixel_candidates > 0).astype(np.uint8)).mean_rectangles(windows)
+
+        # fillPoly only changes the pixels inside the bounding box of its contour, so the filling ratio of a box that
+        # overlaps the box of an earlier contour of the loop is counted again on the mask as it is at that point
+        filled_windows = np.empty((0, 4), dtype=windows.dtype)
+
+        for contour, (x, y, width, height), filling_ratio, window in zip(contours, bboxes, filling_ratios, windows):
+            tly, tlx, bry, brx = window
+            if filling_ratio is None or np.any((filled_windows[:, 0] < bry) & (tly < filled_windows[:, 2]) &
+                                               (filled_windows[:, 1] < brx) & (tlx < filled_windows[:, 3])):
+                filling_ratio = cv2.countNonZero(pixel_candidates[tly:bry, tlx:brx]) / (width * height)
+            filled_windows = np.vstack([filled_windows, window])
 
             print(filling_ratio)
 
@@ -153,12 +173,46 @@ class TemplateMatching(Traffic_sign_model):
 
         return pixel_candidates
 
+    def check_filling_ratio(self, n_images=8, seed=0):
+        """
+        Checks that ccl_generation_filtering gives the same masks with the integral image filling ratios as counting
+        the pixels of every box in the loop (filling_ratio_mode 'count'). Every random mask has L shapes with a line
+        through the empty corner of their bounding box: the line is erased in the loop (low filling ratio) before the
+        L shape is checked, so the boxes overlap and the filling ratio of the L shape changes.
+        :return: number of images with a different mask
+        """
+        rng = np.random.RandomState(seed)
+        mode = self.filling_ratio_mode
+        different = 0
+        try:
+            for i in range(n_images):
+                mask = np.zeros((320, 320), dtype=np.uint8)
+                for x, y in ((0, 0), (160, 0), (0, 160), (160, 160)):
+                    thickness = int(rng.randint(4, 16))
+                    cv2.rectangle(mask, (x + 20, y + 10), (x + 110, y + 10 + thickness), 255, -1)
+                    cv2.rectangle(mask, (x + 110 - thickness, y + 10), (x + 110, y + 90), 255, -1)
+                    cv2.line(mask, (x + 70, y + 45), (x + int(rng.randint(5, 30)), y + 140), 255, 6)
+
+                self.filling_ratio_mode = 'count'
+                count_mask = self.ccl_generation_filtering(mask.copy())
+                self.filling_ratio_mode = 'integral'
+                integral_mask = self.ccl_generation_filtering(mask.copy())
+
+                if not np.array_equal(count_mask, integral_mask):
+                    different += 1
+                    print('random_{}'.format(i), np.count_nonzero(count_mask != integral_mask), 'different pixels')
+        finally:
+            self.filling_ratio_mode = mode
+
+        print(different, 'of', n_images, 'masks are different')
+        return different
 
 
     def __init__(self):
         Traffic_sign_model.__init__(self)
         self.window_method_name = '3_templatematching'
         self.pixel_method_name = 'hsvmorph'
+        self.filling_ratio_mode = 'integral'   # 'integral' (all the boxes at once) or 'count' (every box in the loop)
 
         self.parameters = {
             'blue_low_h': [104, 90, 140],
@@ -187,8 +241,9 @@ class TemplateMatching(Traffic_sign_model):
         }
 
 
-model = TemplateMatching()
-model.evaluate(split='val', output_dir='test_results/')
+if __name__ == "__main__":
+    model = TemplateMatching()
+    model.evaluate(split='val', output_dir='test_results/')
 
 
 
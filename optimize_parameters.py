@@ -2,25 +2,32 @@ import numpy as np
 import cv2
 import imageio
 import time
-from data import Data_handler
+from data import Data_handler, Instance
+from hsv_histogram import HSVHistogram
+from stage_cache import StageCache
 from traffic_signs.evaluation.evaluation_funcs import performance_accumulation_pixel, performance_accumulation_window
 from traffic_signs.evaluation.evaluation_funcs import performance_evaluation_pixel, performance_evaluation_window
 
 
-def morph_transformation(pixel_candidates):
+def kernel_size(size, scale):
+    return max(1, int(round(size * scale)))
+
+
+def morph_transformation(pixel_candidates, scale=1.0):
     """
     Performs morphological operations over the masks.
 
     :param pixel_candidates: the pixels of the image
+    :param scale: scale of the image with respect to the original images, the kernels and the area limits are scaled
     :return: more pixels
     """
 
     # kernel = np.ones((5, 5), np.uint8)
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size(5, scale), kernel_size(5, scale)))
     pixel_candidates = cv2.morphologyEx(pixel_candidates, cv2.MORPH_OPEN, kernel)
 
     # kernel = np.ones((10, 10), np.uint8)
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size(10, scale), kernel_size(10, scale)))
     pixel_candidates = cv2.morphologyEx(pixel_candidates, cv2.MORPH_CLOSE, kernel)
 
     # find all contours (segmented areas) of the mask to delete those that are not consistent with the train split
@@ -28,8 +35,8 @@ def morph_transformation(pixel_candidates):
 
     max_aspect_ratio = 1.419828704905269 * 1.25
     min_aspect_ratio = 0.5513618362563639 * 0.75
-    max_area = 55919.045 * 1.15
-    min_area = 909.7550000000047 * 0.75
+    max_area = 55919.045 * 1.15 * scale ** 2
+    min_area = 909.7550000000047 * 0.75 * scale ** 2
 
     image, contours, hierarchy = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -57,7 +64,7 @@ def morph_transformation(pixel_candidates):
             #cv2.rectangle(pixel_candidates, (x, y), (x + w, y + h), 50, 2)
 
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size(10, scale), kernel_size(10, scale)))
     pixel_candidates = cv2.dilate(pixel_candidates, kernel, iterations=1)
 
     image, contours, hierarchy = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
@@ -109,22 +116,33 @@ def pixel_method(im,
 
     return final_mask // 254
 
-def evaluate_parameters(train_split, blue_low_hsv, blue_high_hsv, red1_low_hsv, red1_high_hsv, red2_low_hsv, red2_high_hsv):
+def evaluate_parameters(train_split, blue_low_hsv, blue_high_hsv, red1_low_hsv, red1_high_hsv, red2_low_hsv, red2_high_hsv,
+                        stage_cache=None, scale=1.0, start_count=0):
+    """
+    If a StageCache is given the HSV images and the masks of the color ranges that did not change since the last
+    evaluation are taken from it.
+    scale is the scale of the images of train_split (see reduced_split)
+    start_count is the initial value of the pixel counts (successive_halving starts them at 1 in its small rungs)
+    """
 
-    pixelTP, pixelTN, pixelFP, pixelFN = 0, 0, 0, 0
+    pixelTP, pixelTN, pixelFP, pixelFN = start_count, start_count, start_count, start_count
     for image_instance in train_split:
-        image = cv2.imread(image_instance.img)
-        color_segmentation_mask = pixel_method(image,
-                        blue_low_hsv=blue_low_hsv,
-                        blue_high_hsv=blue_high_hsv,
-                        red1_low_hsv=red1_low_hsv,
-                        red1_high_hsv=red1_high_hsv,
-                        red2_low_hsv=red2_low_hsv,
-                        red2_high_hsv=red2_high_hsv)
+        if stage_cache is not None:
+            color_ranges = [(blue_low_hsv, blue_high_hsv), (red1_low_hsv, red1_high_hsv), (red2_low_hsv, red2_high_hsv)]
+            color_segmentation_mask = stage_cache.color_segmentation(image_instance, color_ranges) // 254
+        else:
+            image = image_instance.img_view
+            color_segmentation_mask = pixel_method(image,
+                            blue_low_hsv=blue_low_hsv,
+                            blue_high_hsv=blue_high_hsv,
+                            red1_low_hsv=red1_low_hsv,
+                            red1_high_hsv=red1_high_hsv,
+                            red2_low_hsv=red2_low_hsv,
+                            red2_high_hsv=red2_high_hsv)
 
-        pixel_candidates = morph_transformation(color_segmentation_mask)
+        pixel_candidates = morph_transformation(color_segmentation_mask, scale)
 
-        pixel_annotation = imageio.imread('{}/mask/mask.{}.png'.format(directory, image_instance.img_id)) > 0
+        pixel_annotation = image_instance.msk_view
 
         [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = performance_accumulation_pixel(
             pixel_candidates=pixel_candidates,
@@ -137,6 +155,123 @@ def evaluate_parameters(train_split, blue_low_hsv, blue_high_hsv, red1_low_hsv,
     return performance_evaluation_pixel(pixelTP, pixelFP, pixelFN, pixelTN)
 
 
+def hsv_ranges(parameters):
+    """
+    HSV bounds of the current parameters, as keyword arguments of evaluate_parameters
+    """
+    return {'blue_low_hsv':  (parameters['blue_low_h'][0], parameters['blue_low_s'][0], parameters['blue_low_v'][0]),
+            'blue_high_hsv': (parameters['blue_high_h'][0], parameters['blue_high_s'][0], parameters['blue_high_v'][0]),
+            'red1_low_hsv':  (parameters['red1_low_h'][0], parameters['red1_low_s'][0], parameters['red1_low_v'][0]),
+            'red1_high_hsv': (parameters['red1_high_h'][0], parameters['red1_high_s'][0], parameters['red1_high_v'][0]),
+            'red2_low_hsv':  (parameters['red2_low_h'][0], parameters['red2_low_s'][0], parameters['red2_low_v'][0]),
+            'red2_high_hsv': (parameters['red2_high_h'][0], parameters['red2_high_s'][0], parameters['red2_high_v'][0])}
+
+
+def build_hsv_histogram(train_split):
+    """
+    Bins all the pixels of the split in the HSV histograms of ground truth positive and negative pixels
+    """
+    histogram = HSVHistogram()
+    for image_instance in train_split:
+        histogram.add_image(image_instance.img_view, image_instance.msk_view)
+    histogram.compute_cumulative()
+    return histogram
+
+
+def surrogate_evaluate_parameters(histogram, blue_low_hsv, blue_high_hsv, red1_low_hsv, red1_high_hsv, red2_low_hsv,
+                                  red2_high_hsv):
+    """
+    Same as evaluate_parameters but computed from the HSV histograms, so it is the performance of the color segmentation
+    before the morphological operations. It takes microseconds instead of a full pass over the split.
+    """
+    [pixelTP, pixelFP, pixelFN, pixelTN] = histogram.performance_accumulation_pixel(
+        [(blue_low_hsv, blue_high_hsv), (red1_low_hsv, red1_high_hsv), (red2_low_hsv, red2_high_hsv)])
+
+    # +1 just to avoid division by zero
+    return performance_evaluation_pixel(pixelTP + 1, pixelFP + 1, pixelFN + 1, pixelTN + 1)
+
+
+def surrogate_ranking(histogram, parameters, parameter, candidates):
+    """
+    Sorts the candidate values of a parameter by their surrogate score (best first)
+    """
+    current_value = parameters[parameter][0]
+    surrogate_scores = []
+    for p in candidates:
+        parameters[parameter][0] = p
+        [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = surrogate_evaluate_parameters(
+            histogram, **hsv_ranges(parameters))
+        surrogate_scores.append(score(precision=pixel_precision, sensitivity=pixel_sensitivity))
+    parameters[parameter][0] = current_value
+
+    return [p for _, p in sorted(zip(surrogate_scores, candidates), key=lambda pair: -pair[0])]
+
+
+def reduced_split(train_split, scale):
+    """
+    Copy of the instances with the images and masks resized by scale (the original instances if scale is 1)
+    """
+    if scale == 1:
+        return train_split
+
+    reduced = []
+    for image_instance in train_split:
+        instance = Instance(image_instance.img, image_instance.msk, image_instance.img_id)
+        instance.img_view = cv2.resize(image_instance.img_view, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        instance.msk_view = cv2.resize(np.uint8(image_instance.msk_view), None, fx=scale, fy=scale,
+                                       interpolation=cv2.INTER_NEAREST) > 0
+        reduced.append(instance)
+    return reduced
+
+
+def build_fidelities(train_split, rungs, stage_cache=None, seed=0):
+    """
+    Splits of every rung of the successive halving. The subsets are nested (the first images of the same random
+    order) and the last rung is always the whole train_split at full resolution.
+    :param rungs: [(fraction of train_split, scale), ...] from the lowest to the highest fidelity
+    :param stage_cache: StageCache of the full fidelity rung
+    :return: [(split, scale, stage_cache), ...]
+    """
+    order = np.random.RandomState(seed).permutation(len(train_split))
+    fidelities = []
+    for fraction, scale in rungs:
+        if fraction >= 1 and scale == 1:
+            break
+        n_images = max(1, int(round(fraction * len(train_split))))
+        split = reduced_split([train_split[i] for i in order[:n_images]], scale)
+        fidelities.append((split, scale, StageCache() if stage_cache is not None else None))
+    fidelities.append((train_split, 1.0, stage_cache))
+    return fidelities
+
+
+def successive_halving(fidelities, parameters, parameter, candidates, eta=3):
+    """
+    Scores the candidate values of a parameter on rungs of increasing fidelity (more images, higher resolution) and
+    only promotes the best 1/eta of them to the next rung, so most candidates are only evaluated on a few small images.
+    The counts of the small rungs start at 1, to avoid division by zero when nothing is detected in a few small
+    images. The last rung is evaluated like the full search, so its scores can be compared with it.
+    :param fidelities: output of build_fidelities
+    :return: [(value, [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity]), ...] of the candidates
+             evaluated on the last rung (whole train split at full resolution), best first
+    """
+    current_value = parameters[parameter][0]
+    for rung, (split, scale, rung_cache) in enumerate(fidelities):
+        start_count = 1 if rung < len(fidelities) - 1 else 0
+        results = []
+        for p in candidates:
+            parameters[parameter][0] = p
+            metrics = evaluate_parameters(train_split=split, stage_cache=rung_cache, scale=scale,
+                                          start_count=start_count, **hsv_ranges(parameters))
+            results.append((score(precision=metrics[0], sensitivity=metrics[3]), p, metrics))
+        results.sort(key=lambda result: -result[0])
+        print("rung", rung, ":", len(candidates), "candidates on", len(split), "images at scale", scale)
+
+        candidates = [p for _, p, _ in results[:max(1, int(np.ceil(len(results) / eta)))]]
+    parameters[parameter][0] = current_value
+
+    return [(p, metrics) for _, p, metrics in results]
+
+
 def save_progress(parameters, parameter, t1, current_max_value, current_precision, current_sensitivity):
     with open('optimization_parameters.log', "a") as f:
         f.write("-------------------------------- "+parameter+"\n")
@@ -158,12 +293,23 @@ def score(precision, sensitivity):
     return 0.7*sensitivity+0.3*precision
 
 MAX_RANGE = 40
+SURROGATE_TOP_K = 5   # candidates of every parameter evaluated with the full pipeline (0 evaluates all of them)
+USE_STAGE_CACHE = True   # keep the HSV images and the color range masks of the split in memory between evaluations
+                         # (of the images that fit in stage_cache.MEMORY_BUDGET)
+
+# 'full': every candidate is evaluated on the whole train split
+# 'successive_halving': the candidates (the SURROGATE_TOP_K best ones if it is not 0) are evaluated on small subsets
+#                       at reduced resolution first and only the best ones reach the whole split
+SEARCH_MODE = 'full'
+SH_RUNGS = [(0.1, 0.25), (0.3, 0.5), (1.0, 1.0)]   # (fraction of the train split, image scale) of every rung
+SH_ETA = 3   # the best 1/SH_ETA candidates of every rung are promoted to the next one
 
 ##############################################################################################################
 
 #### DATA LOADING ############################################################################################
 data_handler = Data_handler()
 train_set, valid_set, test_set = data_handler.read_all()
+data_handler.materialize('train')   # decode the train split only once for all the passes
 
 train_split = train_set
 directory = "./train/"
@@ -193,25 +339,20 @@ with open('optimization_parameters.log', "a") as f:
     f.write("*************************************************\n")
 t1 = time.time()
 
-blue_low_hsv = (parameters['blue_low_h'][0], parameters['blue_low_s'][0], parameters['blue_low_v'][0])
-blue_high_hsv = (parameters['blue_high_h'][0], parameters['blue_high_s'][0], parameters['blue_high_v'][0])
-red1_low_hsv = (parameters['red1_low_h'][0], parameters['red1_low_s'][0], parameters['red1_low_v'][0])
-red1_high_hsv = (parameters['red1_high_h'][0], parameters['red1_high_s'][0], parameters['red1_high_v'][0])
-red2_low_hsv = (parameters['red2_low_h'][0], parameters['red2_low_s'][0], parameters['red2_low_v'][0])
-red2_high_hsv = (parameters['red2_high_h'][0], parameters['red2_high_s'][0], parameters['red2_high_v'][0])
+if SURROGATE_TOP_K:
+    hsv_histogram = build_hsv_histogram(train_split)
+stage_cache = StageCache() if USE_STAGE_CACHE else None
+if SEARCH_MODE == 'successive_halving':
+    fidelities = build_fidelities(train_split, SH_RUNGS, stage_cache)
 
 [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = evaluate_parameters(
     train_split=train_split,
-    blue_low_hsv = blue_low_hsv,
-    blue_high_hsv = blue_high_hsv,
-    red1_low_hsv = red1_low_hsv,
-    red1_high_hsv = red1_high_hsv,
-    red2_low_hsv = red2_low_hsv,
-    red2_high_hsv = red2_high_hsv
+    stage_cache=stage_cache,
+    **hsv_ranges(parameters)
     )
 
 current_max_value = score(precision=pixel_precision, sensitivity=pixel_sensitivity)
-currrent_precision = pixel_precision
+current_precision = pixel_precision
 current_sensitivity = pixel_sensitivity
 last_current_max_value = 0
 ########################################## OPTIMIZATION ###############################################################
@@ -225,33 +366,34 @@ while(current_max_value - last_current_max_value > 0.001):
         start_range = max(parameters[parameter][1], current_parameter - MAX_RANGE//2)
         end_range = min(parameters[parameter][2], current_parameter + MAX_RANGE//2)
 
-        for p in range(start_range, end_range):
-            if(p!=current_parameter):
-                print(p)
+        candidates = [p for p in range(start_range, end_range) if p != current_parameter]
+        if SURROGATE_TOP_K:
+            # only the most promising values according to the histograms go through the whole pipeline
+            candidates = surrogate_ranking(hsv_histogram, parameters, parameter, candidates)[:SURROGATE_TOP_K]
+
+        if SEARCH_MODE == 'successive_halving':
+            # the shortlist of the surrogate (or all the candidates) goes to the first rung, only the candidates that
+            # survive the low fidelity rungs are evaluated on the whole split
+            evaluated = successive_halving(fidelities, parameters, parameter, candidates, eta=SH_ETA)
+        else:
+            evaluated = []
+            for p in candidates:
                 parameters[parameter][0] = p
-                blue_low_hsv = (parameters['blue_low_h'][0], parameters['blue_low_s'][0], parameters['blue_low_v'][0])
-                blue_high_hsv = (parameters['blue_high_h'][0], parameters['blue_high_s'][0], parameters['blue_high_v'][0])
-                red1_low_hsv = (parameters['red1_low_h'][0], parameters['red1_low_s'][0], parameters['red1_low_v'][0])
-                red1_high_hsv = (parameters['red1_high_h'][0], parameters['red1_high_s'][0], parameters['red1_high_v'][0])
-                red2_low_hsv = (parameters['red2_low_h'][0], parameters['red2_low_s'][0], parameters['red2_low_v'][0])
-                red2_high_hsv = (parameters['red2_high_h'][0], parameters['red2_high_s'][0], parameters['red2_high_v'][0])
-
-                [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = evaluate_parameters(
+                evaluated.append((p, evaluate_parameters(
                     train_split=train_split,
-                    blue_low_hsv=blue_low_hsv,
-                    blue_high_hsv=blue_high_hsv,
-                    red1_low_hsv=red1_low_hsv,
-                    red1_high_hsv=red1_high_hsv,
-                    red2_low_hsv=red2_low_hsv,
-                    red2_high_hsv=red2_high_hsv
-                    )
-                value = score(precision=pixel_precision, sensitivity=pixel_sensitivity)
-                print(value)
-                if (value > current_max_value):
-                    current_parameter = p
-                    current_max_value = value
-                    current_precision = pixel_precision
-                    current_sensitivity = pixel_sensitivity
+                    stage_cache=stage_cache,
+                    **hsv_ranges(parameters)
+                    )))
+
+        for p, [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] in evaluated:
+            print(p)
+            value = score(precision=pixel_precision, sensitivity=pixel_sensitivity)
+            print(value)
+            if (value > current_max_value):
+                current_parameter = p
+                current_max_value = value
+                current_precision = pixel_precision
+                current_sensitivity = pixel_sensitivity
 
         parameters[parameter][0] = current_parameter
         save_progress(parameters=parameters,
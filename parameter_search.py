@@ -0,0 +1,231 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+
+from data import Data_handler
+from stage_cache import MEMORY_BUDGET, StageCache
+from traffic_sign_model import Traffic_sign_model
+
+
+class ParameterJournal():
+    """
+    Append-only journal of the evaluated color parameters, one JSON object per line:
+        {"parameters": {name: value, ...}, "precision": .., "sensitivity": .., "score": .., "wall_time": seconds}
+    Every result is flushed to disk as soon as it arrives, so an interrupted search keeps all its results and a new
+    search with the same journal skips the parameters that are already in it.
+    """
+    def __init__(self, filename):
+        self.filename  = filename
+        self.records   = []
+        self.evaluated = set()
+
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                content = f.read()
+            for line in content.splitlines():
+                try:
+                    self.add(json.loads(line))
+                except ValueError:
+                    pass   # last line cut by an interruption
+            if content and not content.endswith("\n"):
+                with open(filename, "a") as f:
+                    f.write("\n")
+
+    @staticmethod
+    def key(parameters):
+        return tuple(sorted((name, int(value)) for name, value in parameters.items()))
+
+    def __contains__(self, parameters):
+        return self.key(parameters) in self.evaluated
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        self.records.append(record)
+        self.evaluated.add(self.key(record['parameters']))
+
+    def append(self, record):
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.add(record)
+
+    def best(self, n=1):
+        """
+        :return: the n records with the highest score
+        """
+        return sorted(self.records, key=lambda record: -record['score'])[:n]
+
+
+def random_candidate(parameter_ranges, rng):
+    """
+    Parameters drawn uniformly from [start_range, end_range] of every parameter
+    """
+    return {name: int(rng.randint(start, end + 1)) for name, (_, start, end) in parameter_ranges.items()}
+
+
+def local_candidate(parameter_ranges, journal, rng, top=5, spread=0.1):
+    """
+    Gaussian perturbation of one of the top best parameters of the journal (spread is the standard deviation as a
+    fraction of the range of every parameter)
+    """
+    best = journal.best(top)
+    if not best:
+        return random_candidate(parameter_ranges, rng)
+
+    base = best[rng.randint(len(best))]['parameters']
+    candidate = {}
+    for name, (_, start, end) in parameter_ranges.items():
+        sigma = max(1.0, spread * (end - start))
+        candidate[name] = int(np.clip(round(base[name] + rng.normal(0, sigma)), start, end))
+    return candidate
+
+
+def next_candidate(parameter_ranges, journal, pending, rng, strategy, max_tries=1000):
+    """
+    :return: parameters that are not in the journal nor being evaluated (None if none was found)
+    """
+    initial = {name: values[0] for name, values in parameter_ranges.items()}
+    if initial not in journal and ParameterJournal.key(initial) not in pending:
+        return initial
+
+    for _ in range(max_tries):
+        if strategy == 'local':
+            candidate = local_candidate(parameter_ranges, journal, rng)
+        else:
+            candidate = random_candidate(parameter_ranges, rng)
+        if candidate not in journal and ParameterJournal.key(candidate) not in pending:
+            return candidate
+    return None
+
+
+# model, split and stage cache of the current worker process, set once by init_worker
+worker_model = None
+worker_split = None
+worker_stage_cache = None
+
+
+def init_worker(split, train_dir, cache_images='budget', cache_memory=MEMORY_BUDGET):
+    global worker_model, worker_split, worker_stage_cache
+    data_handler = Data_handler(train_dir=train_dir)
+    data_handler.read_all()
+    worker_split = data_handler.materialize(split)   # the store already exists, it is only memory-mapped
+    worker_model = Traffic_sign_model()
+    worker_stage_cache = StageCache(max_images=cache_images, memory_budget=cache_memory)
+
+
+def evaluate_worker(parameters):
+    t1 = time.time()
+    for name, value in parameters.items():
+        worker_model.parameters[name][0] = value
+
+    [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = worker_model.evaluate_parameters(
+        worker_split, worker_stage_cache)
+
+    return {'parameters': parameters,
+            'precision': float(pixel_precision),
+            'sensitivity': float(pixel_sensitivity),
+            'score': float(Traffic_sign_model.score(precision=pixel_precision, sensitivity=pixel_sensitivity)),
+            'wall_time': time.time() - t1}
+
+
+def search(journal_name='parameter_search.jsonl', evaluations=100, workers=4, strategy='random', split='train',
+           train_dir='./train/', seed=0, cache_images='budget', cache_memory=MEMORY_BUDGET):
+    """
+    Asynchronous parallel search of the color parameters of Traffic_sign_model. Every worker process evaluates one
+    candidate at a time and gets a new one as soon as it finishes, the results go to the journal as they arrive.
+    :param journal_name: journal of the search, the search continues from it if it exists
+    :param evaluations: total number of evaluations in the journal to stop the search
+    :param workers: number of processes
+    :param strategy: 'random' (uniform in the ranges of Traffic_sign_model.parameters) or 'local' (around the best
+                     parameters evaluated so far)
+    :param split: can be one of the following: 'val', 'train'
+    :param seed: seed of the candidates (a resumed search with the same seed does not repeat the evaluated ones)
+    :param cache_images: images of the split whose HSV image and range masks are cached by every worker (max_images
+                         of StageCache). Every worker has its own cache of about 14 MB per 1628x1236 image (HSV image
+                         and 4 masks, stage_cache.image_bytes), so the cache takes up to workers x cache_memory bytes
+                         with 'budget' (the default) and workers x 14 MB x images of the split with None (the whole
+                         split, e.g. 4 x 14 MB x 1000 images = 56 GB)
+    :param cache_memory: bytes of the cache of every worker with cache_images='budget'
+    :return: best record of the journal
+    """
+    journal = ParameterJournal(journal_name)
+    parameter_ranges = Traffic_sign_model().parameters
+    rng = np.random.RandomState(seed)
+    print(len(journal), "evaluations found in", journal_name)
+
+    # the store of the split is written once here, the workers only map it
+    data_handler = Data_handler(train_dir=train_dir)
+    data_handler.read_all()
+    data_handler.materialize(split)
+
+    results = queue.Queue()
+    pending = set()
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(split, train_dir, cache_images, cache_memory))
+
+    def submit():
+        while len(pending) < workers and len(journal) + len(pending) < evaluations:
+            candidate = next_candidate(parameter_ranges, journal, pending, rng, strategy)
+            if candidate is None:
+                break
+            pending.add(ParameterJournal.key(candidate))
+            pool.apply_async(evaluate_worker, (candidate,), callback=results.put, error_callback=results.put)
+
+    try:
+        submit()
+        while pending:
+            record = results.get()
+            if isinstance(record, Exception):
+                raise record
+            pending.discard(ParameterJournal.key(record['parameters']))
+            journal.append(record)
+            print(len(journal), "score:", record['score'], "precision:", record['precision'],
+                  "sensitivity:", record['sensitivity'], "time:", record['wall_time'])
+            submit()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    best = journal.best()
+    if best:
+        print("best:", best[0])
+        return best[0]
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-journal', type=str, default="parameter_search.jsonl", help='Journal of the search (it is '
+                                                                                    'resumed if it exists)')
+    parser.add_argument('-evaluations', type=int, default=100, help='Total number of evaluations')
+    parser.add_argument('-workers', type=int, default=4, help='Number of processes (every process has its own '
+                                                              'cache of HSV images, see -cache_mb)')
+    parser.add_argument('-strategy', type=str, default="random", help='random or local')
+    parser.add_argument('-split', type=str, default="train", help='Split used to score the parameters')
+    parser.add_argument('-train_dir', type=str, default="./train/", help='Directory with the train images')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the candidates')
+    parser.add_argument('-cache_images', type=str, default="budget", help='Images cached by every process: a number, '
+                                                                          'budget (as many as fit in -cache_mb) or all '
+                                                                          '(the whole split, about 14 MB per 1628x1236 '
+                                                                          'image and process)')
+    parser.add_argument('-cache_mb', type=int, default=MEMORY_BUDGET // 2 ** 20, help='Memory of the cache of every '
+                                                                                     'process with -cache_images '
+                                                                                     'budget (MB)')
+    args = parser.parse_args()
+    if args.cache_images == 'all':
+        cache_images = None
+    elif args.cache_images == 'budget':
+        cache_images = 'budget'
+    else:
+        cache_images = int(args.cache_images)
+    search(journal_name=args.journal, evaluations=args.evaluations, workers=args.workers, strategy=args.strategy,
+           split=args.split, train_dir=args.train_dir, seed=args.seed, cache_images=cache_images,
+           cache_memory=args.cache_mb * 2 ** 20)
@@ -0,0 +1,186 @@
+import cv2
+import numpy as np
+
+
+class PixelPipeline():
+    """
+    Compiled version of the stages of Traffic_sign_model.pixel_method (color segmentation with cv2.inRange,
+    morph_transformation and ccl_generation_filtering) with the same result.
+    The structuring elements and the HSV bounds are built once, and every intermediate image (HSV image, masks of the
+    ranges, morphology results, labels...) is written with dst= into a buffer that is kept between calls, keyed by its
+    name and shape. Once an image of a shape has been processed, the next ones of the same shape only allocate their
+    output mask (OpenCV still allocates its own small temporaries).
+    Every model (so every worker process) has its own pipeline. The buffers are not pickled.
+    """
+    def __init__(self, color_ranges, aspect_ratio_range, area_range, ccl_mode='contours'):
+        """
+        :param color_ranges: list of (low, high) HSV bounds, e.g. [(blue_low, blue_high), (red_1_low, red_1_high), ...]
+        :param aspect_ratio_range: (min, max) aspect ratio (width / height) of the regions kept
+        :param area_range: (min, max) area of the bounding box of the regions kept
+        :param ccl_mode: 'contours' or 'labels', like Traffic_sign_model.ccl_mode
+        """
+        self.open_kernel   = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        self.close_kernel  = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+        self.dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+
+        self.min_aspect_ratio, self.max_aspect_ratio = aspect_ratio_range
+        self.min_area, self.max_area = area_range
+        self.ccl_mode = ccl_mode
+
+        self.buffers = {}   # (name, shape, dtype) -> array
+        self.stack_shape = None   # (N * H, W) of the buffers of the last color_segmentation_stack
+        self.set_color_ranges(color_ranges)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        return state
+
+    def set_color_ranges(self, color_ranges):
+        self.color_ranges = [(np.array(low, dtype='uint8'), np.array(high, dtype='uint8'))
+                             for low, high in color_ranges]
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """
+        :return: the buffer with that name and shape (created the first time, its content is not initialized)
+        """
+        key = (name, shape, np.dtype(dtype).str)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buffer
+        return buffer
+
+    def clear(self):
+        self.buffers = {}
+        self.stack_shape = None
+
+    def drop_buffers(self, shape):
+        """
+        Removes the buffers of the images of that (height, width)
+        """
+        self.buffers = {key: buffer for key, buffer in self.buffers.items() if key[1][:2] != shape}
+
+    def run(self, im, out=None):
+        """
+        All the stages
+        :param im: BGR image
+        :param out: array where the mask is written (a new one if None)
+        :return: mask with the pixel candidates, window_candidates ([tly, tlx, bry, brx]) if ccl_mode is 'labels' or
+                 None
+        """
+        mask = self.color_segmentation(im)
+        mask = self.morph_transformation(mask)
+        return self.ccl_generation_filtering(mask, out)
+
+    def color_segmentation(self, im):
+        """
+        :param im: BGR image
+        :return: mask with the color segmentation (a buffer of the pipeline)
+        """
+        hsv_image  = cv2.cvtColor(im, cv2.COLOR_BGR2HSV, dst=self.buffer('hsv', im.shape))
+        mask       = self.buffer('color_mask', im.shape[:2])
+        range_mask = self.buffer('range_mask', im.shape[:2])
+
+        (low, high), other_ranges = self.color_ranges[0], self.color_ranges[1:]
+        cv2.inRange(hsv_image, low, high, dst=mask)
+        for low, high in other_ranges:
+            cv2.inRange(hsv_image, low, high, dst=range_mask)
+            cv2.bitwise_or(mask, range_mask, dst=mask)
+
+        return mask
+
+    def color_segmentation_stack(self, ims):
+        """
+        Color segmentation of a stack of images seen as one tall image. Only the buffers of the last stack shape are
+        kept, so batches of different sizes do not pile up buffers.
+        :param ims: (N, H, W, 3) array of BGR images
+        :return: (N, H, W) masks (a buffer of the pipeline)
+        """
+        n, height, width = ims.shape[:3]
+        shape = (n * height, width)
+        if self.stack_shape is not None and self.stack_shape != shape:
+            self.drop_buffers(self.stack_shape)
+        self.stack_shape = shape
+
+        return self.color_segmentation(ims.reshape(n * height, width, 3)).reshape(n, height, width)
+
+    def morph_transformation(self, mask):
+        """
+        Opening (5x5) and closing (10x10)
+        :return: mask (a buffer of the pipeline)
+        """
+        opened = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.open_kernel, dst=self.buffer('opened', mask.shape))
+        return cv2.morphologyEx(opened, cv2.MORPH_CLOSE, self.close_kernel, dst=self.buffer('closed', mask.shape))
+
+    def ccl_generation_filtering(self, mask, out=None):
+        """
+        Filtering of the regions, dilation and filtering again, like Traffic_sign_model.ccl_generation_filtering
+        :param mask: mask, it is modified
+        :param out: array where the result is written (a new one if None)
+        :return: mask, window_candidates if ccl_mode is 'labels' or None
+        """
+        if out is None:
+            out = np.empty(mask.shape, dtype=np.uint8)
+
+        if self.ccl_mode == 'labels':
+            filtered, _ = self.filter_components(mask, self.buffer('filtered', mask.shape))
+            dilated = cv2.dilate(filtered, self.dilate_kernel, dst=self.buffer('dilated', mask.shape))
+            return self.filter_components(dilated, out)
+
+        self.filter_contours(mask)
+        cv2.dilate(mask, self.dilate_kernel, dst=out)
+        self.filter_contours(out)
+        return out, None
+
+    def keep_region(self, width, height):
+        return self.max_aspect_ratio > width / height > self.min_aspect_ratio and \
+            self.max_area > width * height > self.min_area
+
+    def filter_contours(self, mask):
+        # fills the external contours of the regions that are consistent with the train split analysis, erases the rest
+        _, contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+        for contour in contours:
+            x, y, width, height = cv2.boundingRect(contour)
+            cv2.fillPoly(mask, pts=[contour], color=255 if self.keep_region(width, height) else 0)
+
+    def filter_components(self, mask, out):
+        """
+        Traffic_sign_model.filter_components with the buffers of the pipeline
+        :return: out, window_candidates
+        """
+        binary = cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY, dst=self.buffer('binary', mask.shape))[1]
+
+        # fill the holes (background not connected to the border)
+        height, width = mask.shape
+        flooded = cv2.copyMakeBorder(binary, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0,
+                                     dst=self.buffer('flooded', (height + 2, width + 2)))
+        flood_mask = self.buffer('flood_mask', (height + 4, width + 4))   # without it floodFill allocates one
+        flood_mask.fill(0)
+        cv2.floodFill(flooded, flood_mask, (0, 0), 1)
+        filled = cv2.compare(flooded[1:-1, 1:-1], 0, cv2.CMP_EQ, dst=self.buffer('filled', mask.shape))
+        cv2.bitwise_or(filled, binary, dst=filled)
+
+        n_labels, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+            filled, 8, cv2.CV_32S, cv2.CCL_GRANA, labels=self.buffer('labels', mask.shape, np.int32))
+
+        widths  = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+        heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+        aspect_ratio = widths / heights
+        area = widths * heights
+
+        keep = (self.max_aspect_ratio > aspect_ratio) & (aspect_ratio > self.min_aspect_ratio) & \
+               (self.max_area > area) & (area > self.min_area)
+        keep[0] = False   # background
+
+        # only the boxes of the kept regions are written, np.take over the whole labels image would copy them to int64
+        out.fill(0)
+        for label in np.flatnonzero(keep):
+            x, y, w, h = stats[label, :4]
+            out[y:y + h, x:x + w][labels[y:y + h, x:x + w] == label] = 255
+
+        x, y, w, h = [stats[keep, i] for i in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT)]
+        window_candidates = np.stack([y, x, y + h, x + w], axis=1).tolist()
+
+        return out, window_candidates
@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+
+def block_occupancy(mask, block_size):
+    """
+    :param mask: binary mask
+    :param block_size: side of the blocks (pixels)
+    :return: boolean map with one element per block (the last row and column of blocks can be smaller), True if the
+             block has any pixel different from 0
+    """
+    height, width = mask.shape
+    rows, cols = -(-height // block_size), -(-width // block_size)
+    if rows * block_size != height or cols * block_size != width:
+        mask = cv2.copyMakeBorder(mask, 0, rows * block_size - height, 0, cols * block_size - width,
+                                  cv2.BORDER_CONSTANT, value=0)
+
+    blocks = mask.reshape(rows, block_size, cols * block_size).max(axis=1)
+    return blocks.reshape(rows, cols, block_size).max(axis=2) > 0
+
+
+def kernel_reach(kernel):
+    # distance from the anchor (the center) to the farthest element of the kernel
+    return max(kernel.shape) // 2
+
+
+def roi_morphology(mask, op, kernel, block_size=32):
+    """
+    cv2.morphologyEx only around the occupied blocks of the mask, with the same result as over the whole mask.
+
+    A pixel of the result only depends on the pixels of the mask closer than the reach of the operation (reach of the
+    kernel, twice for an opening or a closing), and it is 0 if all of them are 0. The occupied blocks are grown by twice
+    the reach and grouped into rectangles. Every rectangle is processed as a crop of the mask, and only its inner part
+    (the rectangle without the reach, on the sides that are not the border of the image, where the border of the crop
+    makes a difference) is copied to the result. The inner parts cover all the pixels closer than the reach to an
+    occupied block, the rest of the result is 0.
+    :param mask: binary mask (uint8)
+    :param op: cv2.MORPH_OPEN, cv2.MORPH_CLOSE, cv2.MORPH_DILATE or cv2.MORPH_ERODE
+    :param kernel: structuring element (anchor in the center)
+    :param block_size: side of the blocks of the occupancy map (pixels)
+    :return: result of the operation (new mask)
+    """
+    height, width = mask.shape
+    reach = kernel_reach(kernel) * (2 if op in (cv2.MORPH_OPEN, cv2.MORPH_CLOSE) else 1)
+    result = np.zeros_like(mask)
+
+    occupancy = block_occupancy(mask, block_size).astype(np.uint8)
+    if not occupancy.any():
+        # every operation of an empty mask is empty
+        return result
+
+    grow = int(np.ceil(2 * reach / block_size))
+    occupancy = cv2.dilate(occupancy, np.ones((2 * grow + 1, 2 * grow + 1), np.uint8))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(occupancy, 8, cv2.CV_32S)
+
+    for left, top, blocks_width, blocks_height, _ in stats[1:]:
+        tly, tlx = top * block_size, left * block_size
+        bry = min((top + blocks_height) * block_size, height)
+        brx = min((left + blocks_width) * block_size, width)
+
+        crop_result = cv2.morphologyEx(mask[tly:bry, tlx:brx], op, kernel)
+
+        inner_tly = tly + reach if tly > 0 else 0
+        inner_tlx = tlx + reach if tlx > 0 else 0
+        inner_bry = bry - reach if bry < height else height
+        inner_brx = brx - reach if brx < width else width
+        result[inner_tly:inner_bry, inner_tlx:inner_brx] = \
+            crop_result[inner_tly - tly:inner_bry - tly, inner_tlx - tlx:inner_brx - tlx]
+
+    return result
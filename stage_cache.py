@@ -0,0 +1,113 @@
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+
+MEMORY_BUDGET = 2 ** 30   # bytes of a StageCache with max_images='budget'
+
+
+def image_bytes(shape, max_masks=4):
+    """
+    :param shape: shape of the (BGR) images
+    :return: bytes of the cached stages of one image (HSV image and max_masks masks), e.g. about 14 MB for 1628x1236
+    """
+    height, width = shape[:2]
+    return height * width * (3 + max_masks)
+
+
+class StageCache():
+    """
+    Per-image cache of the first stages of the color segmentation, for the parameter optimization.
+    The HSV image of every image is computed once, and the mask of every color range is kept keyed by the six
+    thresholds of the range. When the optimization sweeps one parameter only one of the three ranges changes, so only
+    its cv2.inRange (and the stages after the color segmentation) are recomputed.
+    Memory: one HSV image and up to max_masks masks per image (image_bytes), for up to max_images images. By default
+    ('budget') max_images is the number of images of the shape of the first one that fit in memory_budget bytes. With
+    None all the images of the split are cached.
+    The splits are swept in the same order in every evaluation, so once max_images images are cached the rest are
+    computed again every time instead of replacing them (a least recently used policy would miss on every image).
+    """
+    def __init__(self, max_masks=4, max_images='budget', memory_budget=MEMORY_BUDGET):
+        self.max_masks  = max_masks
+        self.max_images = max_images
+        self.memory_budget = memory_budget
+        self.hsv_images = {}   # img_id -> HSV image
+        self.masks      = {}   # img_id -> OrderedDict {(low_h, low_s, low_v, high_h, high_s, high_v): mask}
+
+    def hsv_image(self, instance):
+        """
+        :param instance: Instance of the image (the image is only read if its HSV image is not cached)
+        :return: HSV image
+        """
+        hsv_image = self.hsv_images.get(instance.img_id)
+        if hsv_image is None:
+            im = instance.img_view if instance.img_view is not None else cv2.imread(instance.img)
+            hsv_image = cv2.cvtColor(im, cv2.COLOR_BGR2HSV)
+            if self.is_cached(instance):
+                self.hsv_images[instance.img_id] = hsv_image
+        return hsv_image
+
+    def is_cached(self, instance):
+        """
+        :return: True if the stages of the image are (or can be) kept in the cache
+        """
+        if instance.img_id in self.hsv_images:
+            return True
+        if self.max_images == 'budget':
+            shape = instance.img_view.shape if instance.img_view is not None else cv2.imread(instance.img).shape
+            self.max_images = self.memory_budget // image_bytes(shape, self.max_masks)
+        return self.max_images is None or len(self.hsv_images) < self.max_images
+
+    def range_mask(self, instance, low, high):
+        """
+        :param instance: Instance of the image
+        :param low: HSV lower bound of the range
+        :param high: HSV upper bound of the range
+        :return: cv2.inRange mask of the range (0 or 255)
+        """
+        key = tuple(int(value) for value in low) + tuple(int(value) for value in high)
+        if not self.is_cached(instance):
+            return cv2.inRange(self.hsv_image(instance), np.array(low, dtype='uint8'), np.array(high, dtype='uint8'))
+        masks = self.masks.setdefault(instance.img_id, OrderedDict())
+
+        if key in masks:
+            masks.move_to_end(key)
+            return masks[key]
+
+        mask = cv2.inRange(self.hsv_image(instance), np.array(low, dtype='uint8'), np.array(high, dtype='uint8'))
+        masks[key] = mask
+        if len(masks) > self.max_masks:
+            masks.popitem(last=False)   # least recently used
+        return mask
+
+    def color_segmentation(self, instance, color_ranges):
+        """
+        Same mask as Traffic_sign_model.color_segmentation with the given ranges
+        :param instance: Instance of the image
+        :param color_ranges: [(blue_low, blue_high), (red_1_low, red_1_high), (red_2_low, red_2_high)]
+        :return: mask with the color segmentation (0 or 255)
+        """
+        [(blue_low, blue_high), (red_1_low, red_1_high), (red_2_low, red_2_high)] = color_ranges
+
+        if not self.is_cached(instance):
+            # the HSV image is computed once for the three ranges
+            hsv_image = self.hsv_image(instance)
+            mask = cv2.inRange(hsv_image, np.array(red_1_low, dtype='uint8'), np.array(red_1_high, dtype='uint8'))
+            for low, high in [(red_2_low, red_2_high), (blue_low, blue_high)]:
+                mask = cv2.bitwise_or(mask, cv2.inRange(hsv_image, np.array(low, dtype='uint8'),
+                                                        np.array(high, dtype='uint8')))
+            return mask
+
+        mask_hue_red_1 = self.range_mask(instance, red_1_low, red_1_high)
+        mask_hue_red_2 = self.range_mask(instance, red_2_low, red_2_high)
+
+        combined_red_mask = cv2.bitwise_or(mask_hue_red_1, mask_hue_red_2)
+        mask_hue_blue = self.range_mask(instance, blue_low, blue_high)
+        final_mask = cv2.bitwise_or(combined_red_mask, mask_hue_blue)
+
+        return final_mask
+
+    def clear(self):
+        self.hsv_images = {}
+        self.masks = {}
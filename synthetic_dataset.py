@@ -0,0 +1,264 @@
+import argparse
+import multiprocessing
+import os
+import pickle
+import shutil
+
+import numpy as np
+import cv2
+import imageio
+
+from data import Data_handler
+
+
+UNKNOWN_SIGN_TYPE = 'U'   # type written in the ground truth of the signs of data/templates (they have no type)
+
+
+class Synthetic_dataset():
+    """
+    Seedable generator of synthetic images with traffic signs, for scale testing. The signs of data/templates and of
+    the folders written by Data_analysis.create_templates (data/A, data/B...) are pasted over procedurally generated
+    backgrounds with random size, aspect ratio, hue, saturation, brightness, blur, noise and JPEG quality.
+    Every image only depends on (seed, index), so any range of images can be generated again, in any order and with any
+    number of processes, and the result is the same.
+    The output has the layout read by Data_handler (run from output_dir):
+        output_dir/train/{id}.jpg, output_dir/train/mask/mask.{id}.png (0 or 1), output_dir/train/gt/gt.{id}.txt
+        output_dir/test/{id}.jpg
+        output_dir/data/train_split.pkl, val_split.pkl, test_split.pkl and a copy of data/templates
+    """
+    def __init__(self, data_dir='./data/', seed=0, width=1628, height=1236, max_signs=3, min_size=30, max_size=240,
+                 hue_jitter=4):
+        """
+        :param data_dir: folder with templates/ and the optional sign type folders (A, B, ...)
+        :param width: width of the images
+        :param height: height of the images
+        :param max_signs: maximum number of signs per image (at least one)
+        :param min_size: minimum side of a sign (pixels)
+        :param max_size: maximum side of a sign (pixels)
+        :param hue_jitter: maximum shift of the hue of a sign (OpenCV hue units, 0-180)
+        """
+        self.data_dir   = data_dir
+        self.seed       = seed
+        self.width      = width
+        self.height     = height
+        self.max_signs  = max_signs
+        self.min_size   = min_size
+        self.max_size   = max_size
+        self.hue_jitter = hue_jitter
+        self.signs      = self.load_signs(data_dir)
+
+    @staticmethod
+    def load_signs(data_dir):
+        """
+        :return: [(bgr sign, mask of the sign, sign type), ...] (the mask is gray > 5, like in TemplateBank)
+        """
+        folders = [('templates', UNKNOWN_SIGN_TYPE)] + [(sign_type, sign_type) for sign_type in Data_handler().types]
+
+        signs = []
+        for folder, sign_type in folders:
+            folder_dir = data_dir + folder + "/"
+            if not os.path.isdir(folder_dir):
+                continue
+            for filename in sorted(os.listdir(folder_dir)):
+                sign = cv2.imread(folder_dir + filename)
+                if sign is None:
+                    continue
+                mask = cv2.cvtColor(sign, cv2.COLOR_BGR2GRAY) > 5
+                signs.append((sign, mask, sign_type))
+
+        if not signs:
+            raise ValueError('No signs found in ' + data_dir)
+        return signs
+
+    def random_state(self, index):
+        return np.random.RandomState([self.seed, index])
+
+    def background(self, rng):
+        """
+        Sum of random noise at several scales, a vertical gradient (sky and road) and some random rectangles (buildings,
+        cars, including some red or blue distractors)
+        """
+        height, width = self.height, self.width
+
+        background = np.zeros((height, width, 3), dtype=np.float32)
+        for cells, weight in ((4, 0.5), (16, 0.3), (64, 0.2)):
+            grid = rng.uniform(0, 255, size=(max(2, cells * height // width), cells, 3)).astype(np.float32)
+            background += weight * cv2.resize(grid, (width, height), interpolation=cv2.INTER_CUBIC)
+
+        gradient = np.linspace(rng.uniform(-40, 40), rng.uniform(-40, 40), height, dtype=np.float32)
+        background += gradient[:, None, None]
+
+        # low saturation: the color of every pixel is pulled towards its gray level
+        gray = background.mean(axis=2, keepdims=True)
+        background = gray + rng.uniform(0.1, 0.4) * (background - gray)
+
+        for _ in range(rng.randint(0, 12)):
+            x, y = rng.randint(0, width), rng.randint(0, height)
+            w, h = rng.randint(width // 40, width // 4), rng.randint(height // 40, height // 4)
+            color = rng.uniform(0, 255, size=3)
+            cv2.rectangle(background, (x, y), (x + w, y + h), color.tolist(), -1)
+
+        return np.clip(background, 0, 255).astype(np.uint8)
+
+    def transform_sign(self, sign, mask, rng):
+        """
+        Resizes the sign and changes its hue, saturation and brightness
+        :return: sign, mask
+        """
+        size = rng.uniform(self.min_size, self.max_size)
+        aspect_ratio = rng.uniform(0.85, 1.15)
+        dsize = (max(2, int(round(size * aspect_ratio))), max(2, int(round(size))))   # (width, height)
+
+        sign = cv2.resize(sign, dsize, interpolation=cv2.INTER_AREA if size < sign.shape[0] else cv2.INTER_CUBIC)
+        mask = cv2.resize(np.uint8(mask), dsize, interpolation=cv2.INTER_NEAREST) > 0
+
+        hsv = cv2.cvtColor(sign, cv2.COLOR_BGR2HSV).astype(np.float32)
+        hsv[:, :, 0] = np.mod(hsv[:, :, 0] + rng.uniform(-self.hue_jitter, self.hue_jitter), 180)
+        hsv[:, :, 1] *= rng.uniform(0.7, 1.2)
+        hsv[:, :, 2] *= rng.uniform(0.5, 1.2)
+        sign = cv2.cvtColor(np.clip(hsv, 0, [179, 255, 255]).astype(np.uint8), cv2.COLOR_HSV2BGR)
+
+        return sign, mask
+
+    def generate_image(self, index):
+        """
+        :param index: index of the image
+        :return: image (BGR), mask (0 or 1), annotations [([tly, tlx, bry, brx], sign type), ...]
+        """
+        rng = self.random_state(index)
+        im = self.background(rng)
+        mask = np.zeros((self.height, self.width), dtype=np.uint8)
+        annotations = []
+
+        for _ in range(rng.randint(1, self.max_signs + 1)):
+            sign, sign_mask, sign_type = self.signs[rng.randint(len(self.signs))]
+            sign, sign_mask = self.transform_sign(sign, sign_mask, rng)
+            height, width = sign_mask.shape
+            if height >= self.height or width >= self.width or not sign_mask.any():
+                continue
+
+            # a few tries to find a place that does not overlap the other signs
+            for _ in range(20):
+                y, x = rng.randint(0, self.height - height), rng.randint(0, self.width - width)
+                if not mask[y:y + height, x:x + width].any():
+                    break
+            else:
+                continue
+
+            im[y:y + height, x:x + width][sign_mask] = sign[sign_mask]
+            mask[y:y + height, x:x + width][sign_mask] = 1
+
+            rows, cols = np.nonzero(sign_mask)
+            annotations.append(([float(y + rows.min()), float(x + cols.min()), float(y + rows.max() + 1),
+                                 float(x + cols.max() + 1)], sign_type))
+
+        if rng.rand() < 0.5:
+            im = cv2.GaussianBlur(im, (3, 3), rng.uniform(0.3, 1.2))
+        noise = rng.normal(0, rng.uniform(0, 10), size=im.shape)
+        im = np.clip(im + noise, 0, 255).astype(np.uint8)
+
+        return im, mask, annotations
+
+    def jpeg_quality(self, index):
+        return int(self.random_state(index).randint(60, 96))
+
+    @staticmethod
+    def image_id(index):
+        return 's{:07d}'.format(index)
+
+    def write_image(self, index, train_dir, test_dir=None):
+        """
+        Writes the image, its mask and its ground truth (only the image for the test split, if test_dir is given)
+        :return: id of the image
+        """
+        id_ = self.image_id(index)
+        im, mask, annotations = self.generate_image(index)
+        quality = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality(index)]
+
+        if test_dir is not None:
+            cv2.imwrite(test_dir + id_ + ".jpg", im, quality)
+            return id_
+
+        cv2.imwrite(train_dir + id_ + ".jpg", im, quality)
+        imageio.imwrite(train_dir + "mask/mask." + id_ + ".png", mask)
+        with open(train_dir + "gt/gt." + id_ + ".txt", "w") as f:
+            for bbox, sign_type in annotations:
+                f.write("{} {} {} {} {}\n".format(*bbox, sign_type))
+        return id_
+
+    def write(self, output_dir='./synthetic/', n_images=1000, n_test=0, val_prop=0.3, workers=1):
+        """
+        Writes a synthetic dataset with the layout of the real one.
+        :param output_dir: root folder of the dataset
+        :param n_images: number of images with annotations (train and validation splits)
+        :param n_test: number of images of the test split (without annotations)
+        :param val_prop: proportion of the annotated images in the validation split
+        :param workers: number of processes
+        :return: train ids, validation ids, test ids
+        """
+        train_dir = output_dir + "/train/"
+        test_dir  = output_dir + "/test/"
+        split_dir = output_dir + "/data/"
+        for directory in [train_dir + "mask/", train_dir + "gt/", test_dir, split_dir]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        # the template matching methods read ./data/templates
+        if os.path.isdir(self.data_dir + "templates") and not os.path.exists(split_dir + "templates"):
+            shutil.copytree(self.data_dir + "templates", split_dir + "templates")
+
+        tasks = [(index, train_dir, None) for index in range(n_images)] + \
+                [(index, train_dir, test_dir) for index in range(n_images, n_images + n_test)]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(self,))
+            try:
+                ids = list(pool.imap(write_image_worker, tasks, chunksize=64))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            ids = [self.write_image(*task) for task in tasks]
+
+        annotated_ids = ids[:n_images]
+        order = np.random.RandomState([self.seed, 2 ** 31 - 1]).permutation(n_images)
+        n_val = int(round(val_prop * n_images))
+        valid_ids = [annotated_ids[i] for i in sorted(order[:n_val])]
+        train_ids = [annotated_ids[i] for i in sorted(order[n_val:])]
+        test_ids  = ids[n_images:]
+
+        for name, split_ids in [("train_split.pkl", train_ids), ("val_split.pkl", valid_ids),
+                                ("test_split.pkl", test_ids)]:
+            with open(split_dir + name, "wb") as f:
+                pickle.dump(split_ids, f)
+
+        return train_ids, valid_ids, test_ids
+
+
+# generator of the current worker process, set once by init_worker
+worker_dataset = None
+
+
+def init_worker(dataset):
+    global worker_dataset
+    worker_dataset = dataset
+
+
+def write_image_worker(task):
+    return worker_dataset.write_image(*task)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-output_dir', type=str, default="./synthetic/", help='Root folder of the dataset')
+    parser.add_argument('-n_images', type=int, default=1000, help='Number of images with annotations')
+    parser.add_argument('-n_test', type=int, default=0, help='Number of test images')
+    parser.add_argument('-val_prop', type=float, default=0.3, help='Proportion of validation images')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the dataset')
+    parser.add_argument('-width', type=int, default=1628, help='Width of the images')
+    parser.add_argument('-height', type=int, default=1236, help='Height of the images')
+    parser.add_argument('-workers', type=int, default=1, help='Number of processes')
+    args = parser.parse_args()
+
+    dataset = Synthetic_dataset(seed=args.seed, width=args.width, height=args.height)
+    dataset.write(args.output_dir, n_images=args.n_images, n_test=args.n_test, val_prop=args.val_prop,
+                  workers=args.workers)
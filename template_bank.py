@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+class TemplateBank():
+    """
+    Holds the templates of ./data/templates in all the representations used by the template matching methods, so they
+    are read and converted once per process instead of once per image:
+        self.bgr        list of BGR templates (uint8)
+        self.gray       list of gray templates (float32)
+        self.mask       list of binary masks of the templates (gray > 5), with 3 channels like the BGR templates
+        self.means      mean of every gray template
+        self.norms      norm of every gray template minus its mean (denominator of TM_CCOEFF_NORMED)
+    The resized versions are computed the first time a size is asked for and kept for the next regions.
+    Use get_template_bank() to get the bank of the process.
+    """
+    def __init__(self, templates_dir="./data/templates/", max_cached_sizes=64):
+        self.templates_dir = templates_dir
+        self.filenames     = os.listdir(templates_dir)
+
+        self.bgr  = []
+        self.gray = []
+        self.mask = []
+        for filename in self.filenames:
+            template = cv2.imread(templates_dir + filename)
+            template_mask = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+            _, template_mask = cv2.threshold(template_mask, 5, 255, cv2.THRESH_BINARY)
+
+            self.bgr.append(template)
+            self.gray.append(cv2.cvtColor(template, cv2.COLOR_BGR2GRAY).astype(np.float32))
+            self.mask.append(cv2.cvtColor(template_mask, cv2.COLOR_GRAY2BGR))
+
+        self.means, self.norms = self.statistics(self.gray)
+
+        self.max_cached_sizes = max_cached_sizes
+        self.gray_cache = OrderedDict()   # {size: (stack of resized gray templates, means, norms)}
+        self.mask_cache = OrderedDict()   # {(width, height): resized masks}
+
+    @staticmethod
+    def statistics(templates):
+        means = np.array([template.mean() for template in templates], dtype=np.float64)
+        norms = np.array([np.sqrt(np.sum((template.astype(np.float64) - mean) ** 2))
+                          for template, mean in zip(templates, means)])
+        return means, norms
+
+    def resized_gray(self, size):
+        """
+        Gray templates resized to (size, size) with cubic interpolation
+        :param size: side of the resized templates
+        :return: templates (array of shape (number of templates, size, size)), means, norms
+        """
+        if size not in self.gray_cache:
+            templates = np.stack([cv2.resize(template, dsize=(size, size), interpolation=cv2.INTER_CUBIC)
+                                  for template in self.gray])
+            means, norms = self.statistics(templates)
+            self.add_to_cache(self.gray_cache, size, (templates, means, norms))
+        else:
+            self.gray_cache.move_to_end(size)
+        return self.gray_cache[size]
+
+    def resized_mask(self, dsize):
+        """
+        Masks of the templates resized to dsize
+        :param dsize: (width, height)
+        :return: list of masks
+        """
+        if dsize not in self.mask_cache:
+            self.add_to_cache(self.mask_cache, dsize, [cv2.resize(mask, dsize) for mask in self.mask])
+        else:
+            self.mask_cache.move_to_end(dsize)
+        return self.mask_cache[dsize]
+
+    def add_to_cache(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.max_cached_sizes:
+            cache.popitem(last=False)
+
+
+template_banks = {}   # {templates_dir: TemplateBank}, one per process
+
+
+def get_template_bank(templates_dir="./data/templates/"):
+    """
+    Returns the template bank of the directory, it is only loaded the first time.
+    """
+    if templates_dir not in template_banks:
+        template_banks[templates_dir] = TemplateBank(templates_dir)
+    return template_banks[templates_dir]
@@ -1,15 +1,37 @@
 import argparse
 import numpy as np
 import cv2
+import imageio
 
 from data import Data_handler
 from data_analysis import Data_analysis
+from color_lut import ColorLUT
+from template_bank import get_template_bank
+from fft_matching import match_templates_ccoeff_normed
+from stage_cache import StageCache
+from roi_morphology import roi_morphology
+from pixel_pipeline import PixelPipeline
 from traffic_signs import traffic_sign_detection as detection
+from traffic_signs.tracing import get_tracer
 from traffic_signs.evaluation.bbox_iou import bbox_iou
+from traffic_signs.evaluation.evaluation_funcs import performance_accumulation_pixel
+from traffic_signs.evaluation.evaluation_funcs import performance_accumulation_pixel_packed
+from traffic_signs.evaluation.evaluation_funcs import performance_evaluation_pixel
 import matplotlib.pyplot as plt
 import os
 import time
 
+# limits of the regions kept by ccl_generation_filtering, from the analysis of the train split
+MAX_ASPECT_RATIO = 1.419828704905269 * 1.25
+MIN_ASPECT_RATIO = 0.5513618362563639 * 0.75
+MAX_AREA = 55919.045 * 1.15
+MIN_AREA = 909.7550000000047 * 0.75
+
+# growth of the morphological operations of pixel_method (opening 5x5, closing 10x10 and the dilation 10x10 of
+# ccl_generation_filtering), with some slack
+TILE_MARGIN = 32
+
+
 class Traffic_sign_model():
     def __init__(self):
         self.pixel_method_name  = '1_dsfsdff'
@@ -44,33 +66,380 @@ class Traffic_sign_model():
         }
         self.MAX_RANGE = 40 #max range to search for optimal parameter
 
+        self.color_segmentation_mode = 'inrange'   # 'inrange' or 'lut' (precomputed BGR -> mask lookup table)
+        self.color_lut = None
+        self.color_lut_key = None
+
+        self.template_matching_engine = 'opencv'   # 'opencv' (one matchTemplate per template) or 'fft' (batched)
+
+        self.ccl_mode  = 'contours'   # 'contours' or 'labels' (connected component statistics, see ccl_filtering_labels)
+        self.ccl_boxes = None         # (mask, window_candidates) of the last ccl_filtering_labels call
+
+        self.pixel_resolution_mode = 'full'   # 'full', 'coarse_to_fine' (see coarse_to_fine_pixel_method) or 'tiled'
+                                              # (see tiled_pixel_method)
+        self.coarse_scale          = 0.25     # scale of the image searched for candidate regions in 'coarse_to_fine'
+        self.tile_size             = 1024     # side of the part of the image that every tile contributes in 'tiled'
+
+        self.morphology_mode = 'full'   # 'full' or 'roi' (only around the occupied blocks of the mask, see morphology)
+        self.morphology_block_size = 32
+
+        self.pipeline_mode = 'stages'   # 'stages' or 'compiled' (PixelPipeline: kernels, bounds and buffers reused)
+        self.pixel_pipeline = None
+        self.pixel_pipeline_key = None
+
+        self.batch_ccl_boxes = None   # (masks, [window_candidates or None of every mask]) of the last pixel_method_batch
+
     def pixel_method(self, im):
         """
         Color segmentation of red and blue regions and morphological transformations
         :param im: BGR image
         :return: mask with the pixel candidates
         """
+        if self.pixel_resolution_mode == 'coarse_to_fine':
+            return self.coarse_to_fine_pixel_method(im)
+        if self.pixel_resolution_mode == 'tiled':
+            return self.tiled_pixel_method(im)
+        if self.pipeline_mode == 'compiled':
+            return self.compiled_pixel_method(im)
+
+        tracer = get_tracer()
+        with tracer.span('segmentation'):
+            color_segmentation_mask = self.color_segmentation(im)
+        with tracer.span('morphology'):
+            pixel_candidates        = self.morph_transformation(color_segmentation_mask)
+        with tracer.span('ccl'):
+            pixel_candidates        = self.ccl_generation_filtering(pixel_candidates)
 
-        color_segmentation_mask = self.color_segmentation(im)
-        pixel_candidates        = self.morph_transformation(color_segmentation_mask)
-        pixel_candidates        = self.ccl_generation_filtering(pixel_candidates)
+        return pixel_candidates
+
+    def compiled_pixel_method(self, im):
+        """
+        pixel_method through the PixelPipeline of the model: only the returned mask is allocated once the pipeline has
+        processed an image of the same size. The segmentation through the lookup table ('lut') allocates as usual and
+        morphology_mode is not used (the morphology is always over the whole mask).
+        :param im: BGR image
+        :return: mask with the pixel candidates
+        """
+        tracer = get_tracer()
+        pipeline = self.get_pixel_pipeline()
+
+        with tracer.span('segmentation'):
+            if self.color_segmentation_mode == 'lut':
+                color_segmentation_mask = self.color_segmentation(im)
+            else:
+                color_segmentation_mask = pipeline.color_segmentation(im)
+        with tracer.span('morphology'):
+            pixel_candidates = pipeline.morph_transformation(color_segmentation_mask)
+        with tracer.span('ccl'):
+            pixel_candidates, window_candidates = pipeline.ccl_generation_filtering(pixel_candidates)
+
+        if window_candidates is not None:
+            self.ccl_boxes = (pixel_candidates, window_candidates)
 
         return pixel_candidates
 
+    def get_pixel_pipeline(self):
+        """
+        Returns the PixelPipeline of the model. Its bounds are only rebuilt when the color parameters change, its
+        buffers are kept.
+        :return: PixelPipeline
+        """
+        if self.pixel_pipeline is None:
+            self.pixel_pipeline = PixelPipeline(self.color_ranges(), (MIN_ASPECT_RATIO, MAX_ASPECT_RATIO),
+                                                (MIN_AREA, MAX_AREA), self.ccl_mode)
+            self.pixel_pipeline_key = None
+
+        key = tuple(values[0] for values in self.parameters.values())
+        if self.pixel_pipeline_key != key:
+            self.pixel_pipeline.set_color_ranges(self.color_ranges())
+            self.pixel_pipeline_key = key
+        self.pixel_pipeline.ccl_mode = self.ccl_mode
+
+        return self.pixel_pipeline
+
+    def coarse_to_fine_pixel_method(self, im):
+        """
+        Same stages as pixel_method, but the whole image is only segmented at coarse_scale to find the candidate
+        regions. The segmentation, the morphological operations and the filtering of the regions are done at full
+        resolution inside the boxes of those regions only, the rest of the mask is background.
+        The result is the full resolution pipeline applied to the color segmentation inside the candidate boxes, so it
+        only differs from 'full' around regions that are not found (or found smaller) at coarse_scale.
+        :param im: BGR image
+        :return: mask with the pixel candidates (same size as im)
+        """
+        tracer = get_tracer()
+        pixel_candidates = np.zeros(im.shape[:2], dtype=np.uint8)
+
+        with tracer.span('coarse_segmentation'):
+            boxes = self.coarse_candidate_boxes(im)
+        crops = self.roi_crops(boxes, im.shape[:2])
+        tracer.count('refined_regions', len(crops))
+
+        for (tly, tlx, bry, brx), cores in crops:
+            with tracer.span('segmentation'):
+                color_segmentation_mask = self.color_segmentation(im[tly:bry, tlx:brx])
+                # only the pixels of the candidate boxes, the margin of the crop is for the morphological operations
+                core_mask = np.zeros_like(color_segmentation_mask)
+                for core_tly, core_tlx, core_bry, core_brx in cores:
+                    core_mask[core_tly - tly:core_bry - tly, core_tlx - tlx:core_brx - tlx] = 255
+                color_segmentation_mask = cv2.bitwise_and(color_segmentation_mask, core_mask)
+            with tracer.span('morphology'):
+                roi_candidates = self.morph_transformation(color_segmentation_mask)
+            with tracer.span('ccl'):
+                roi_candidates = self.ccl_generation_filtering(roi_candidates)
+
+            cv2.bitwise_or(pixel_candidates[tly:bry, tlx:brx], roi_candidates, dst=pixel_candidates[tly:bry, tlx:brx])
+
+        # the windows of ccl_filtering_labels are relative to the crops
+        self.ccl_boxes = None
+
+        return pixel_candidates
+
+    def coarse_candidate_boxes(self, im):
+        """
+        Candidate regions of the image reduced to coarse_scale (color segmentation and closing). The regions smaller
+        than half the minimum area of ccl_generation_filtering are dropped.
+        :param im: BGR image
+        :return: (N, 4) array of boxes [tly, tlx, bry, brx] at full resolution, with a margin for the rounding
+        """
+        scale = self.coarse_scale
+        small = cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small_mask = self.color_segmentation(small)
+
+        size = max(1, int(round(10 * scale)))
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        small_mask = cv2.morphologyEx(small_mask, cv2.MORPH_CLOSE, kernel)
+
+        _, _, stats, _ = cv2.connectedComponentsWithStats(small_mask, 8, cv2.CV_32S)
+        stats = stats[1:].astype(np.float64)   # without the background
+        area = stats[:, cv2.CC_STAT_WIDTH] * stats[:, cv2.CC_STAT_HEIGHT] / scale ** 2
+        stats = stats[area > MIN_AREA * 0.5]
+
+        margin = int(np.ceil(1 / scale)) + 2
+        height, width = im.shape[:2]
+        tly = np.clip(np.floor(stats[:, cv2.CC_STAT_TOP] / scale) - margin, 0, height)
+        tlx = np.clip(np.floor(stats[:, cv2.CC_STAT_LEFT] / scale) - margin, 0, width)
+        bry = np.clip(np.ceil((stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]) / scale) + margin, 0, height)
+        brx = np.clip(np.ceil((stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]) / scale) + margin, 0, width)
+
+        return np.stack([tly, tlx, bry, brx], axis=1).astype(np.int64)
+
+    @staticmethod
+    def roi_crops(boxes, shape, margin=16):
+        """
+        Groups the boxes whose crops (box + margin) overlap, so every pixel is processed once.
+        :param boxes: (N, 4) array of boxes [tly, tlx, bry, brx]
+        :param shape: (height, width) of the image
+        :param margin: margin of the crops, larger than the growth of the morphological operations
+        :return: [(crop [tly, tlx, bry, brx], [boxes inside the crop]), ...]
+        """
+        height, width = shape
+        crops = []
+        for box in boxes.tolist():
+            crop = [max(box[0] - margin, 0), max(box[1] - margin, 0), min(box[2] + margin, height),
+                    min(box[3] + margin, width)]
+            cores = [box]
+
+            # merge with the crops it overlaps until it does not overlap any
+            merged = True
+            while merged:
+                merged = False
+                for i, (other_crop, other_cores) in enumerate(crops):
+                    if crop[0] < other_crop[2] and other_crop[0] < crop[2] and \
+                            crop[1] < other_crop[3] and other_crop[1] < crop[3]:
+                        crop = [min(crop[0], other_crop[0]), min(crop[1], other_crop[1]),
+                                max(crop[2], other_crop[2]), max(crop[3], other_crop[3])]
+                        cores = cores + other_cores
+                        del crops[i]
+                        merged = True
+                        break
+            crops.append((crop, cores))
+
+        return crops
+
+    def tiled_pixel_method(self, im):
+        """
+        Same stages as pixel_method, run on overlapping tiles so the memory used only depends on tile_size and not on
+        the size of the image (only the output mask has the size of the image).
+        Every tile is the core (tile_size x tile_size) plus a halo of tile_halo() pixels, and only its core is copied to
+        the output mask. The halo is larger than twice the biggest region kept by ccl_generation_filtering plus the
+        growth of the morphological operations, so every region that reaches a core is seen whole and the mask is the
+        same as in 'full' (the only exception is a region enclosed by a contour that leaves the tile, which is much
+        larger than any sign).
+        The windows of the regions are found in the tiles: a region is found by all the tiles that overlap it, only the
+        tile whose core has its top left corner keeps it.
+        :param im: BGR image
+        :return: mask with the pixel candidates (same size as im)
+        """
+        tracer = get_tracer()
+        pixel_candidates = np.zeros(im.shape[:2], dtype=np.uint8)
+        window_candidates = []
+
+        tiles = self.tiles(im.shape[:2], self.tile_size, self.tile_halo())
+        tracer.count('tiles', len(tiles))
+
+        for (tly, tlx, bry, brx), (core_tly, core_tlx, core_bry, core_brx) in tiles:
+            with tracer.span('segmentation'):
+                color_segmentation_mask = self.color_segmentation(im[tly:bry, tlx:brx])
+            with tracer.span('morphology'):
+                tile_candidates = self.morph_transformation(color_segmentation_mask)
+            with tracer.span('ccl'):
+                tile_candidates = self.ccl_generation_filtering(tile_candidates)
+                tile_windows = self.cached_ccl_bbox(tile_candidates)
+
+            pixel_candidates[core_tly:core_bry, core_tlx:core_brx] = \
+                tile_candidates[core_tly - tly:core_bry - tly, core_tlx - tlx:core_brx - tlx]
+
+            for window_tly, window_tlx, window_bry, window_brx in tile_windows:
+                if core_tly <= window_tly + tly < core_bry and core_tlx <= window_tlx + tlx < core_brx:
+                    window_candidates.append([window_tly + tly, window_tlx + tlx, window_bry + tly, window_brx + tlx])
+
+        # window_method takes the windows of the tiles instead of searching the whole mask again
+        self.ccl_boxes = (pixel_candidates, window_candidates)
+
+        return pixel_candidates
+
+    @staticmethod
+    def tile_halo():
+        """
+        :return: halo of the tiles of tiled_pixel_method, twice the largest side of a region kept by
+                 ccl_generation_filtering plus TILE_MARGIN
+        """
+        max_height = np.sqrt(MAX_AREA / MIN_ASPECT_RATIO)   # aspect ratio is width / height
+        max_width  = np.sqrt(MAX_AREA * MAX_ASPECT_RATIO)
+        return 2 * int(np.ceil(max(max_height, max_width))) + TILE_MARGIN
+
+    @staticmethod
+    def tiles(shape, tile_size, halo):
+        """
+        :param shape: (height, width) of the image
+        :param tile_size: side of the cores
+        :param halo: pixels added to every side of the cores (clipped to the image)
+        :return: [(tile [tly, tlx, bry, brx], core [tly, tlx, bry, brx]), ...], the cores cover the image once
+        """
+        height, width = shape
+        tiles = []
+        for core_tly in range(0, height, tile_size):
+            for core_tlx in range(0, width, tile_size):
+                core = [core_tly, core_tlx, min(core_tly + tile_size, height), min(core_tlx + tile_size, width)]
+                tile = [max(core[0] - halo, 0), max(core[1] - halo, 0), min(core[2] + halo, height),
+                        min(core[3] + halo, width)]
+                tiles.append((tile, core))
+        return tiles
+
     def window_method(self, im, pixel_candidates):
         # Format of the bboxes is [tly, tlx, bry, brx, ...], where tl and br
         
-        window_candidates = self.get_ccl_bbox(pixel_candidates)
+        window_candidates = self.cached_ccl_bbox(pixel_candidates)
         #final_mask, window_candidates = self.template_matching( im, pixel_candidates, threshold=.2, show=False)
+        get_tracer().count('candidate_regions', len(window_candidates))
         
         return window_candidates
 
         # return window_candidates
-    def evaluate(self, split = 'train', output_dir='results/'):
+    def pixel_method_batch(self, ims):
+        """
+        pixel_method over a batch of images. The images of the same shape are segmented together: the color
+        segmentation (cv2.cvtColor + cv2.inRange, or the lookup table) is a per-pixel operation, so it is done once for
+        the whole stack seen as one tall image. The morphological operations and the filtering of the regions are done
+        per image. Same masks as pixel_method.
+        :param ims: (N, H, W, 3) array of BGR images, or list of BGR images (of any shapes, the images with the same
+                    shape are stacked and processed together)
+        :return: (N, H, W) array of masks, or list of masks if ims is a list
+        """
+        if isinstance(ims, np.ndarray):
+            pixel_candidates, window_candidates = self.stack_pixel_method(ims)
+        else:
+            pixel_candidates, window_candidates = [None] * len(ims), [None] * len(ims)
+            groups = {}
+            for i, im in enumerate(ims):
+                groups.setdefault(im.shape, []).append(i)
+            for indices in groups.values():
+                masks, windows = self.stack_pixel_method(np.stack([ims[i] for i in indices]))
+                for i, mask, mask_windows in zip(indices, masks, windows):
+                    pixel_candidates[i], window_candidates[i] = mask, mask_windows
+
+        # window_method_batch takes the windows that are already known
+        self.batch_ccl_boxes = (pixel_candidates, window_candidates)
+
+        return pixel_candidates
+
+    def stack_pixel_method(self, ims):
+        """
+        :param ims: (N, H, W, 3) array of BGR images
+        :return: (N, H, W) array of masks, [window_candidates of every mask if they are known (else None), ...]
+        """
+        tracer = get_tracer()
+        n, height, width = ims.shape[:3]
+        pixel_candidates = np.empty((n, height, width), dtype=np.uint8)
+        window_candidates = [None] * n
+
+        if self.pixel_resolution_mode != 'full':
+            # the tiles and the coarse regions are found per image
+            for i in range(n):
+                mask = self.pixel_method(ims[i])
+                pixel_candidates[i] = mask
+                if self.ccl_boxes is not None and self.ccl_boxes[0] is mask:
+                    window_candidates[i] = self.ccl_boxes[1]
+            return pixel_candidates, window_candidates
+
+        compiled = self.pipeline_mode == 'compiled'
+        pipeline = self.get_pixel_pipeline() if compiled else None
+
+        with tracer.span('segmentation', images=n):
+            if compiled and self.color_segmentation_mode != 'lut':
+                color_segmentation_masks = pipeline.color_segmentation_stack(ims)
+            else:
+                color_segmentation_masks = self.color_segmentation(ims.reshape(n * height, width, 3))
+                color_segmentation_masks = color_segmentation_masks.reshape(n, height, width)
+
+        for i in range(n):
+            with tracer.span('morphology'):
+                if compiled:
+                    mask = pipeline.morph_transformation(color_segmentation_masks[i])
+                else:
+                    mask = self.morph_transformation(color_segmentation_masks[i])
+            with tracer.span('ccl'):
+                if compiled:
+                    _, window_candidates[i] = pipeline.ccl_generation_filtering(mask, out=pixel_candidates[i])
+                else:
+                    mask = self.ccl_generation_filtering(mask)
+                    pixel_candidates[i] = mask
+                    if self.ccl_boxes is not None and self.ccl_boxes[0] is mask:
+                        window_candidates[i] = self.ccl_boxes[1]
+
+        return pixel_candidates, window_candidates
+
+    def window_method_batch(self, ims, pixel_candidates):
+        """
+        window_method over a batch of images
+        :param ims: (N, H, W, 3) array or list of BGR images
+        :param pixel_candidates: masks of the images, as returned by pixel_method_batch
+        :return: [window_candidates of every image, ...]
+        """
+        if self.batch_ccl_boxes is not None and self.batch_ccl_boxes[0] is pixel_candidates:
+            known_windows = self.batch_ccl_boxes[1]
+        else:
+            known_windows = [None] * len(pixel_candidates)
+
+        window_candidates = []
+        for im, mask, windows in zip(ims, pixel_candidates, known_windows):
+            if windows is not None:
+                self.ccl_boxes = (mask, windows)   # used by cached_ccl_bbox
+            window_candidates.append(self.window_method(im, mask))
+        return window_candidates
+
+    def evaluate(self, split = 'train', output_dir='results/', workers=1, write_results=True, output_format='files',
+                 trace_prefix=None):
         """ test both pixel_method and window_method on the selected data split
         and save results in results/
         :param split: can be one of the following: 'test', 'val', 'train'
         :param output_dir: directory to save the masks and the bounding boxes
+        :param workers: number of processes used to run the detection
+        :param write_results: if False the masks and the bounding boxes are not saved (only evaluation)
+        :param output_format: 'files' (one png and one pkl per image) or 'container' (one file for the whole split)
+        :param trace_prefix: if given, the time of every stage of every image is written to trace_prefix.jsonl and
+                             trace_prefix.trace.json
         """
         print('Reading data')
 
@@ -100,7 +469,10 @@ class Traffic_sign_model():
                          window_precision, window_sensitivity, window_accuracy = \
                          detection.traffic_sign_detection(annotations_available, images_dir, data_split, output_dir, \
                                                           self.pixel_method_name,self.pixel_method,
-                                                          self.window_method_name,self.window_method)
+                                                          self.window_method_name,self.window_method,
+                                                          workers=workers, write_results=write_results,
+                                                          output_format=output_format,
+                                                          trace_prefix=trace_prefix)
         metrics = {'pixel_precision': pixel_precision, 
                    'pixel_accuracy': pixel_accuracy, 
                    'pixel_specificity': pixel_specificity, 
@@ -118,28 +490,12 @@ class Traffic_sign_model():
         :return: mask with the color segmentation
         """
 
+        if self.color_segmentation_mode == 'lut':
+            return self.get_color_lut().segment(im)
+
         hsv_image = cv2.cvtColor(im, cv2.COLOR_BGR2HSV)
 
-        blue_low = np.array(
-            (self.parameters['blue_low_h'][0], self.parameters['blue_low_s'][0], self.parameters['blue_low_v'][0]),
-            dtype='uint8')
-        blue_high = np.array(
-            (self.parameters['blue_high_h'][0], self.parameters['blue_high_s'][0], self.parameters['blue_high_v'][0]),
-            dtype='uint8')
-
-        red_1_low = np.array(
-            (self.parameters['red1_low_h'][0], self.parameters['red1_low_s'][0], self.parameters['red1_low_v'][0]),
-            dtype='uint8')
-        red_1_high = np.array(
-            (self.parameters['red1_high_h'][0], self.parameters['red1_high_s'][0], self.parameters['red1_high_v'][0]),
-            dtype='uint8')
-
-        red_2_low = np.array(
-            (self.parameters['red2_low_h'][0], self.parameters['red2_low_s'][0], self.parameters['red2_low_v'][0]),
-            dtype='uint8')
-        red_2_high = np.array(
-            (self.parameters['red2_high_h'][0], self.parameters['red2_high_s'][0], self.parameters['red2_high_v'][0]),
-            dtype='uint8')
+        [(blue_low, blue_high), (red_1_low, red_1_high), (red_2_low, red_2_high)] = self.color_ranges()
 
         mask_hue_red_1 = cv2.inRange(hsv_image, red_1_low, red_1_high)
         mask_hue_red_2 = cv2.inRange(hsv_image, red_2_low, red_2_high)
@@ -150,6 +506,71 @@ class Traffic_sign_model():
 
         return final_mask
 
+    def color_ranges(self):
+        """
+        HSV bounds of the color segmentation taken from self.parameters
+        :return: [(blue_low, blue_high), (red_1_low, red_1_high), (red_2_low, red_2_high)]
+        """
+        ranges = []
+        for color in ['blue', 'red1', 'red2']:
+            low = np.array((self.parameters[color + '_low_h'][0], self.parameters[color + '_low_s'][0],
+                            self.parameters[color + '_low_v'][0]), dtype='uint8')
+            high = np.array((self.parameters[color + '_high_h'][0], self.parameters[color + '_high_s'][0],
+                             self.parameters[color + '_high_v'][0]), dtype='uint8')
+            ranges.append((low, high))
+        return ranges
+
+    def get_color_lut(self):
+        """
+        Returns the lookup table of the current color ranges. It is only rebuilt when the color parameters change.
+        :return: ColorLUT
+        """
+        color_ranges = self.color_ranges()
+        key = tuple(int(value) for bounds in color_ranges for bound in bounds for value in bound)
+
+        if self.color_lut is None or self.color_lut_key != key:
+            self.color_lut = ColorLUT(color_ranges)
+            self.color_lut_key = key
+
+        return self.color_lut
+
+    def check_color_lut(self, split='train', n_images=8, seed=0):
+        """
+        Checks that the lookup table segmentation gives the same masks as the cv2.inRange segmentation.
+        :param split: can be one of the following: 'test', 'val', 'train', or 'random' (n_images random BGR images, no
+                      data needed)
+        :return: number of images with a different mask
+        """
+        if split == 'random':
+            rng = np.random.RandomState(seed)
+            images = [('random_{}'.format(i), rng.randint(0, 256, size=(256, 256, 3)).astype(np.uint8))
+                      for i in range(n_images)]
+        else:
+            data_handler = Data_handler()
+            train_set, valid_set, test_set = data_handler.read_all()
+            data_split = {'train': train_set, 'val': valid_set, 'test': test_set}[split]
+            images = ((instance.img_id, cv2.imread(instance.img)) for instance in data_split)
+
+        mode = self.color_segmentation_mode
+        different = 0
+        checked = 0
+        try:
+            for img_id, im in images:
+                self.color_segmentation_mode = 'inrange'
+                inrange_mask = self.color_segmentation(im)
+                self.color_segmentation_mode = 'lut'
+                lut_mask = self.color_segmentation(im)
+
+                checked += 1
+                if not np.array_equal(inrange_mask, lut_mask):
+                    different += 1
+                    print(img_id, np.count_nonzero(inrange_mask != lut_mask), 'different pixels')
+        finally:
+            self.color_segmentation_mode = mode
+
+        print(different, 'of', checked, 'masks are different')
+        return different
+
 
     def morph_transformation(self, pixel_candidates):
         """
@@ -161,23 +582,37 @@ class Traffic_sign_model():
 
         # kernel = np.ones((5, 5), np.uint8)
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        pixel_candidates = cv2.morphologyEx(pixel_candidates, cv2.MORPH_OPEN, kernel)
+        pixel_candidates = self.morphology(pixel_candidates, cv2.MORPH_OPEN, kernel)
 
         # kernel = np.ones((10, 10), np.uint8)
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
-        pixel_candidates = cv2.morphologyEx(pixel_candidates, cv2.MORPH_CLOSE, kernel)
+        pixel_candidates = self.morphology(pixel_candidates, cv2.MORPH_CLOSE, kernel)
 
         return pixel_candidates
 
+    def morphology(self, pixel_candidates, op, kernel):
+        """
+        cv2.morphologyEx over the whole mask, or only around its occupied blocks if morphology_mode is 'roi' (same
+        result, see roi_morphology)
+        """
+        if self.morphology_mode == 'roi':
+            return roi_morphology(pixel_candidates, op, kernel, self.morphology_block_size)
+        return cv2.morphologyEx(pixel_candidates, op, kernel)
+
 
     def ccl_generation_filtering(self,pixel_candidates):
         # find all contours (segmented areas) of the mask to delete those that are not consistent with the train split
         # analysis
 
-        max_aspect_ratio = 1.419828704905269 * 1.25
-        min_aspect_ratio = 0.5513618362563639 * 0.75
-        max_area = 55919.045 * 1.15
-        min_area = 909.7550000000047 * 0.75
+        if self.ccl_mode == 'labels':
+            pixel_candidates, window_candidates = self.ccl_filtering_labels(pixel_candidates)
+            self.ccl_boxes = (pixel_candidates, window_candidates)
+            return pixel_candidates
+
+        max_aspect_ratio = MAX_ASPECT_RATIO
+        min_aspect_ratio = MIN_ASPECT_RATIO
+        max_area = MAX_AREA
+        min_area = MIN_AREA
 
         image, contours, hierarchy = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -194,7 +629,7 @@ class Traffic_sign_model():
                 cv2.fillPoly(pixel_candidates, pts=[contour], color=0)
 
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
-        pixel_candidates = cv2.dilate(pixel_candidates, kernel, iterations=1)
+        pixel_candidates = self.morphology(pixel_candidates, cv2.MORPH_DILATE, kernel)
 
         image, contours, hierarchy = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
@@ -209,6 +644,56 @@ class Traffic_sign_model():
         return pixel_candidates
 
 
+    def ccl_filtering_labels(self, pixel_candidates):
+        """
+        Same filtering as ccl_generation_filtering but from the statistics of the connected components: the holes of the
+        mask are filled, every component is labeled once and kept or dropped in a single vectorized step through a
+        keep table. No contours are extracted.
+        :param pixel_candidates: mask
+        :return: filtered mask, window_candidates of the kept regions ([tly, tlx, bry, brx])
+        """
+        pixel_candidates, _ = self.filter_components(pixel_candidates)
+
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+        pixel_candidates = self.morphology(pixel_candidates, cv2.MORPH_DILATE, kernel)
+
+        return self.filter_components(pixel_candidates)
+
+    @staticmethod
+    def filter_components(pixel_candidates):
+        # fill the holes (background not connected to the border), like cv2.fillPoly over the external contours
+        flooded = cv2.copyMakeBorder(np.uint8(pixel_candidates > 0), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        cv2.floodFill(flooded, None, (0, 0), 1)
+        filled = np.uint8(flooded[1:-1, 1:-1] == 0)
+        filled |= pixel_candidates > 0
+
+        n_labels, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(filled, 8, cv2.CV_32S,
+                                                                                  cv2.CCL_GRANA)
+
+        width  = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+        height = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+        aspect_ratio = width / height
+        area = width * height
+
+        keep = (MAX_ASPECT_RATIO > aspect_ratio) & (aspect_ratio > MIN_ASPECT_RATIO) & (MAX_AREA > area) & (area > MIN_AREA)
+        keep[0] = False   # background
+
+        keep_table = np.where(keep, 255, 0).astype(np.uint8)
+        pixel_candidates = np.take(keep_table, labels)
+
+        x, y, w, h = [stats[keep, i] for i in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT)]
+        window_candidates = np.stack([y, x, y + h, x + w], axis=1).tolist()
+
+        return pixel_candidates, window_candidates
+
+    def cached_ccl_bbox(self, pixel_candidates):
+        """
+        Windows of the mask. If the mask comes from ccl_filtering_labels its windows are already known.
+        """
+        if self.ccl_boxes is not None and self.ccl_boxes[0] is pixel_candidates:
+            return self.ccl_boxes[1]
+        return self.get_ccl_bbox(pixel_candidates)
+
     def get_ccl_bbox(self, pixel_candidates):
         # Format of the bboxes is [tly, tlx, bry, brx, ...], where tl and br
         window_candidates = []
@@ -234,13 +719,9 @@ class Traffic_sign_model():
         final_mask = pixel_candidates
         window_candidates = []
 
-        # read the templates
-        templates = []
-        template_filenames = os.listdir("./data/templates/")
-        for filename in template_filenames:
-            template = cv2.imread("./data/templates/" + filename)
-            template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY).astype(np.float32)
-            templates.append(template)
+        # the templates are read once per process
+        template_bank = get_template_bank()
+        templates_compared = 0
 
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
         if show:
@@ -268,15 +749,24 @@ class Traffic_sign_model():
 
             # print((dsize, dsize), ", ", region.shape)
 
-            for template in templates:
-                for scalar in scalars:
-                    dsize_scaled = int(dsize * scalar)
-                    template_g = cv2.resize(template, dsize=(dsize_scaled, dsize_scaled), interpolation=cv2.INTER_CUBIC)
-                    res = cv2.matchTemplate(region, template_g, cv2.TM_CCOEFF_NORMED)
+            for scalar in scalars:
+                dsize_scaled = int(dsize * scalar)
+                templates_g, means, norms = template_bank.resized_gray(dsize_scaled)
+                templates_compared += len(templates_g)
+                if self.template_matching_engine == 'fft':
+                    # all the templates are correlated with the region in one batched FFT pass
+                    res = match_templates_ccoeff_normed(region, templates_g, means, norms)
                     max_temp_score = np.max(res)
 
                     if max_temp_score > max_score:
                         max_score = max_temp_score
+                else:
+                    for template_g in templates_g:
+                        res = cv2.matchTemplate(region, template_g, cv2.TM_CCOEFF_NORMED)
+                        max_temp_score = np.max(res)
+
+                        if max_temp_score > max_score:
+                            max_score = max_temp_score
             if show:
                 rec = pat.Rectangle((x_min - padding, y_min - padding), (x_max + padding) - (x_min - padding),
                                     (y_max + padding) - (y_min - padding)
@@ -288,6 +778,8 @@ class Traffic_sign_model():
                 cv2.fillPoly(pixel_candidates, pts=[contour], color=0)
         if show:
             plt.show()
+        get_tracer().count('candidate_regions', len(contours))
+        get_tracer().count('templates_compared', templates_compared)
 
         # calculates the windows for all the regions
         _, contours, _ = cv2.findContours(pixel_candidates, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
@@ -305,28 +797,31 @@ class Traffic_sign_model():
 
 
     def remove_overlapped(self, window_candidates, score_candidates, method = 'union'):
+        # the score of the removed windows is set to None (a score of 0 is a perfect TM_SQDIFF match)
         new_window_candidates = []
 
         if method == 'Non_Maximum_Suppression':
             for i in range(len(window_candidates)):
                 for j in range(i+1,len(window_candidates)):
+                    if score_candidates[i] is None or score_candidates[j] is None:
+                        continue
                     if bbox_iou(window_candidates[i], window_candidates[j]) > 0.5:
                         if score_candidates[i] > score_candidates[j]:
-                            score_candidates[j] = 0    # to be removed in next step
+                            score_candidates[j] = None    # to be removed in next step
                         else:
-                            score_candidates[i] = 0
+                            score_candidates[i] = None
         if method == 'union':
             for i in range(len(window_candidates)):
                 for j in range(i+1,len(window_candidates)):
-                    if bbox_iou(window_candidates[i], window_candidates[j]) > 0.2 and score_candidates[j]:
-                            score_candidates[j]  = 0
+                    if bbox_iou(window_candidates[i], window_candidates[j]) > 0.2 and score_candidates[j] is not None:
+                            score_candidates[j]  = None
                             window_candidates[i] = [ min(window_candidates[i][0],window_candidates[j][0]),
                                                      min(window_candidates[i][1],window_candidates[j][1]),
                                                      max(window_candidates[i][2],window_candidates[j][2]),
                                                      max(window_candidates[i][3],window_candidates[j][3])]
 
         for i in range(len(window_candidates)):
-            if score_candidates[i] > 0:
+            if score_candidates[i] is not None:
                 new_window_candidates.append(window_candidates[i])
 
         return new_window_candidates        
@@ -354,19 +849,61 @@ class Traffic_sign_model():
         print("Precision: " + str(current_precision))
         print("Sensitivity: " + str(current_sensitivity))
 
+    @staticmethod
     def score(precision, sensitivity): #Score function to be optimised
         return 0.7 * sensitivity + 0.3 * precision
 
-    def optimize_parameters(self, train_set):
+    def evaluate_parameters(self, train_set, stage_cache=None):
+        """
+        Pixel performance of pixel_method with the current parameters.
+        :param train_set: list of Instance with masks
+        :param stage_cache: StageCache, keeps the HSV images and the masks of the color ranges between calls so only the
+                            ranges that changed are recomputed
+        :return: [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity]
+        """
+        # +1 just to avoid division by zero (as in traffic_sign_detection)
+        pixelTP, pixelFP, pixelFN, pixelTN = 1, 1, 1, 1
+        for instance in train_set:
+            if stage_cache is not None:
+                color_segmentation_mask = stage_cache.color_segmentation(instance, self.color_ranges())
+            else:
+                im = instance.img_view if instance.img_view is not None else cv2.imread(instance.img)
+                color_segmentation_mask = self.color_segmentation(im)
+            pixel_candidates = self.morph_transformation(color_segmentation_mask)
+            pixel_candidates = self.ccl_generation_filtering(pixel_candidates)
+
+            if instance.msk_packed is not None:
+                local_counts = performance_accumulation_pixel_packed(pixel_candidates, instance.msk_packed)
+            else:
+                pixel_annotation = instance.msk_view if instance.msk_view is not None else imageio.imread(instance.msk)
+                local_counts = performance_accumulation_pixel(pixel_candidates, pixel_annotation)
+            [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = local_counts
+
+            pixelTP = pixelTP + localPixelTP
+            pixelFP = pixelFP + localPixelFP
+            pixelFN = pixelFN + localPixelFN
+            pixelTN = pixelTN + localPixelTN
+
+        return performance_evaluation_pixel(pixelTP, pixelFP, pixelFN, pixelTN)
+
+    def optimize_parameters(self, train_set, stage_cache=None):
+        """
+        Coordinate descent over self.parameters, maximizing score() on train_set
+        :param train_set: list of Instance with masks
+        :param stage_cache: StageCache shared by all the evaluations (a new one if None)
+        """
+        if stage_cache is None:
+            stage_cache = StageCache()
 
         with open('optimization_parameters.log', "a") as f:
             f.write("********************* New Execution ***************************\n")
         t1 = time.time()
 
-        [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = self.evaluate_parameters() #TO DO
+        [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = self.evaluate_parameters(train_set,
+                                                                                                           stage_cache)
 
         current_max_value   = self.score(precision=pixel_precision, sensitivity=pixel_sensitivity)
-        currrent_precision  = pixel_precision
+        current_precision   = pixel_precision
         current_sensitivity = pixel_sensitivity
         last_current_max_value = 0
 
@@ -375,15 +912,16 @@ class Traffic_sign_model():
             for parameter in self.parameters:
 
                 current_parameter = self.parameters[parameter][0]
-                start_range = max(self.parameters[parameter][1], current_parameter - MAX_RANGE // 2)
-                end_range = min(self.parameters[parameter][2], current_parameter + MAX_RANGE // 2)
+                start_range = max(self.parameters[parameter][1], current_parameter - self.MAX_RANGE // 2)
+                end_range = min(self.parameters[parameter][2], current_parameter + self.MAX_RANGE // 2)
 
                 for p in range(start_range, end_range):
                     if (p != current_parameter):
                         print(p)
                         self.parameters[parameter][0] = p
 
-                        [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = self.evaluate_parameters() #TO DO
+                        [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = \
+                            self.evaluate_parameters(train_set, stage_cache)
 
                         value = self.score(precision=pixel_precision, sensitivity=pixel_sensitivity)
                         print(value)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def bbox_iou(bboxA, bboxB):
     # compute the intersection over union of two bboxes
 
@@ -21,3 +24,26 @@ def bbox_iou(bboxA, bboxB):
     
     # return the intersection over union value
     return iou
+
+
+def bbox_iou_matrix(bboxesA, bboxesB):
+    # compute the intersection over union of every bbox in bboxesA with every bbox in bboxesB at once.
+    # Same formula as bbox_iou, returns a (len(bboxesA), len(bboxesB)) array.
+
+    bboxesA = np.array([bbox[:4] for bbox in bboxesA], dtype=np.float64).reshape(-1, 4)
+    bboxesB = np.array([bbox[:4] for bbox in bboxesB], dtype=np.float64).reshape(-1, 4)
+
+    # determine the coordinates of the intersection rectangles
+    xA = np.maximum(bboxesA[:, None, 1], bboxesB[None, :, 1])
+    yA = np.maximum(bboxesA[:, None, 0], bboxesB[None, :, 0])
+    xB = np.minimum(bboxesA[:, None, 3], bboxesB[None, :, 3])
+    yB = np.minimum(bboxesA[:, None, 2], bboxesB[None, :, 2])
+
+    # compute the area of the intersection rectangles
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+
+    # compute the area of all the bboxes
+    bboxesAArea = (bboxesA[:, 2] - bboxesA[:, 0] + 1) * (bboxesA[:, 3] - bboxesA[:, 1] + 1)
+    bboxesBArea = (bboxesB[:, 2] - bboxesB[:, 0] + 1) * (bboxesB[:, 3] - bboxesB[:, 1] + 1)
+
+    return interArea / (bboxesAArea[:, None] + bboxesBArea[None, :] - interArea)
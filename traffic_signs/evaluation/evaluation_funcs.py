@@ -1,5 +1,8 @@
 import numpy as np
-from .bbox_iou import bbox_iou
+from scipy.optimize import linear_sum_assignment
+from .bbox_iou import bbox_iou, bbox_iou_matrix
+from .rle_mask import RLEMask
+from .packed_mask import PackedMask
 
 def performance_accumulation_pixel(pixel_candidates, pixel_annotation):
     """ 
@@ -33,7 +36,71 @@ def performance_accumulation_pixel(pixel_candidates, pixel_annotation):
 
 
 
-def performance_accumulation_window(detections, annotations):
+def performance_accumulation_pixel_rle(pixel_candidates, pixel_annotation):
+    """
+    performance_accumulation_pixel_rle()
+
+    Same as performance_accumulation_pixel with run-length encoded masks. The counts
+    are computed by merging the run lists, so the cost depends on the number of runs
+    (the boundary of the masks) and not on the size of the image.
+
+    [pixelTP, pixelFP, pixelFN, pixelTN] = performance_accumulation_pixel_rle(pixel_candidates, pixel_annotation)
+
+    Parameter name      Value
+    --------------      -----
+    'pixel_candidates'   RLEMask (or binary image) marking the detected areas
+    'pixel_annotation'   RLEMask (or binary image) containing ground truth
+    """
+
+    if not isinstance(pixel_candidates, RLEMask):
+        pixel_candidates = RLEMask.from_dense(pixel_candidates)
+    if not isinstance(pixel_annotation, RLEMask):
+        pixel_annotation = RLEMask.from_dense(pixel_annotation)
+
+    pixelTP = pixel_candidates.intersection_count(pixel_annotation)
+    pixelFP = pixel_candidates.count() - pixelTP
+    pixelFN = pixel_annotation.count() - pixelTP
+    pixelTN = pixel_candidates.size() - pixelTP - pixelFP - pixelFN
+
+    return [pixelTP, pixelFP, pixelFN, pixelTN]
+
+
+
+def performance_accumulation_pixel_packed(pixel_candidates, pixel_annotation):
+    """
+    performance_accumulation_pixel_packed()
+
+    Same as performance_accumulation_pixel with bit-packed masks (one bit per pixel).
+    Only the intersection needs a pass over the masks (an AND and a popcount of
+    1/8 of the pixels), the other counts follow from the number of foreground
+    pixels of each mask:
+        TP = popcount(candidates & annotation)    FP = popcount(candidates) - TP
+        FN = popcount(annotation) - TP            TN = size - TP - FP - FN
+    The ground truth can be packed once (PackedMask.from_dense) and reused.
+
+    [pixelTP, pixelFP, pixelFN, pixelTN] = performance_accumulation_pixel_packed(pixel_candidates, pixel_annotation)
+
+    Parameter name      Value
+    --------------      -----
+    'pixel_candidates'   PackedMask (or binary image) marking the detected areas
+    'pixel_annotation'   PackedMask (or binary image) containing ground truth
+    """
+
+    if not isinstance(pixel_candidates, PackedMask):
+        pixel_candidates = PackedMask.from_dense(pixel_candidates)
+    if not isinstance(pixel_annotation, PackedMask):
+        pixel_annotation = PackedMask.from_dense(pixel_annotation)
+
+    pixelTP = pixel_candidates.intersection_count(pixel_annotation)
+    pixelFP = pixel_candidates.count() - pixelTP
+    pixelFN = pixel_annotation.count() - pixelTP
+    pixelTN = pixel_candidates.size() - pixelTP - pixelFP - pixelFN
+
+    return [pixelTP, pixelFP, pixelFN, pixelTN]
+
+
+
+def performance_accumulation_window(detections, annotations, matching='greedy'):
     """ 
     performance_accumulation_window()
 
@@ -53,20 +120,34 @@ def performance_accumulation_window(detections, annotations):
        --------------      -----
        'detections'        List of windows marking the candidate detections
        'annotations'       List of windows with the ground truth positions of the objects
+       'matching'          'greedy': every annotation takes all the free detections that overlap it
+                           'optimal': one-to-one assignment with the maximum number of True Positives
     
     The function returns the number of True Positive (TP), False Positive (FP), 
     False Negative (FN) objects
     """
     
-    detections_used  = np.zeros(len(detections))
-    annotations_used = np.zeros(len(annotations))
+    detections_used  = np.zeros(len(detections), dtype=bool)
+    annotations_used = np.zeros(len(annotations), dtype=bool)
     TP = 0
-    for ii in range (len(annotations)):
-        for jj in range (len(detections)):
-            if (detections_used[jj] == 0) & (bbox_iou(annotations[ii], detections[jj]) > 0.5):
-                TP = TP+1
-                detections_used[jj]  = 1
-                annotations_used[ii] = 1
+
+    if len(detections) and len(annotations):
+        # overlaps[ii, jj] is True if annotation ii and detection jj overlap by more of 50%
+        overlaps = bbox_iou_matrix(annotations, detections) > 0.5
+
+        if matching == 'optimal':
+            rows, cols = linear_sum_assignment(-overlaps.astype(np.float64))
+            matched = overlaps[rows, cols]
+            TP = int(np.sum(matched))
+            annotations_used[rows[matched]] = True
+            detections_used[cols[matched]]  = True
+        else:
+            for ii in range (len(annotations)):
+                new_detections = overlaps[ii] & ~detections_used
+                if new_detections.any():
+                    TP = TP + int(np.sum(new_detections))
+                    detections_used     |= new_detections
+                    annotations_used[ii] = True
 
     FN = np.sum(annotations_used==0)
     FP = np.sum(detections_used==0)
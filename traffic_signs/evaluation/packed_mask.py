@@ -0,0 +1,49 @@
+import numpy as np
+
+
+# number of bits set in every byte value
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """
+    Number of bits set in a uint8 array
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.sum(np.bitwise_count(packed), dtype=np.int64))
+    return int(np.sum(POPCOUNT_TABLE[packed], dtype=np.int64))
+
+
+class PackedMask():
+    """
+    Binary mask packed to one bit per pixel (np.packbits of the row-major mask), with its number of foreground pixels.
+    It takes 1/8 of a boolean mask and 1/64 of the uint64 masks of performance_accumulation_pixel, so the ground
+    truth masks of a split can be kept packed between evaluations.
+    """
+    def __init__(self, bits, count, shape):
+        self.bits       = bits     # uint8 array, 8 pixels per byte
+        self.foreground = count    # number of foreground pixels
+        self.shape      = shape
+
+    @classmethod
+    def from_dense(cls, mask):
+        """
+        :param mask: binary image, any value > 0 is foreground
+        """
+        bits = np.packbits(np.asarray(mask) > 0)
+        return cls(bits, popcount(bits), tuple(mask.shape[:2]))
+
+    def to_dense(self):
+        return np.unpackbits(self.bits)[:int(np.prod(self.shape))].astype(bool).reshape(self.shape)
+
+    def count(self):
+        return self.foreground
+
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def intersection_count(self, other):
+        """
+        Number of pixels that are foreground in both masks.
+        """
+        return popcount(np.bitwise_and(self.bits, other.bits))
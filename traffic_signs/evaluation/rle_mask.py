@@ -0,0 +1,60 @@
+import numpy as np
+import imageio
+
+
+class RLEMask():
+    """
+    Run-length encoded binary mask. The foreground pixels of the mask (in row-major order) are stored as runs
+    [start, end), so a sparse mask takes a few KB instead of one byte per pixel, and the intersection with another mask
+    is computed by merging the two run lists, without the dense arrays.
+    """
+    def __init__(self, starts, ends, shape):
+        self.starts = starts    # int64 array, first pixel of every run
+        self.ends   = ends      # int64 array, pixel after the last pixel of every run
+        self.shape  = shape
+
+    @classmethod
+    def from_dense(cls, mask):
+        """
+        :param mask: binary image, any value > 0 is foreground (output of pixel_method, ground truth mask...)
+        """
+        flat = np.zeros(mask.size + 2, dtype=np.int8)
+        flat[1:-1] = np.asarray(mask).ravel() > 0
+        changes = np.diff(flat)
+        starts = np.flatnonzero(changes == 1).astype(np.int64)
+        ends   = np.flatnonzero(changes == -1).astype(np.int64)
+        return cls(starts, ends, tuple(mask.shape[:2]))
+
+    @classmethod
+    def from_png(cls, filename):
+        """
+        :param filename: mask image, e.g. mask/mask.{id}.png
+        """
+        return cls.from_dense(imageio.imread(filename) > 0)
+
+    def to_dense(self):
+        flat = np.zeros(int(np.prod(self.shape)) + 1, dtype=np.int8)
+        np.add.at(flat, self.starts, 1)
+        np.add.at(flat, self.ends, -1)
+        return np.cumsum(flat[:-1]).astype(bool).reshape(self.shape)
+
+    def count(self):
+        return int(np.sum(self.ends - self.starts))
+
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def intersection_count(self, other):
+        """
+        Number of pixels that are foreground in both masks.
+        """
+        # sweep over the boundaries of the runs of both masks: between two consecutive boundaries the number of
+        # masks covering the pixels is constant, the pixels covered by both are the intersection
+        positions = np.concatenate([self.starts, self.ends, other.starts, other.ends])
+        steps = np.concatenate([np.ones(len(self.starts), dtype=np.int64), -np.ones(len(self.ends), dtype=np.int64),
+                                np.ones(len(other.starts), dtype=np.int64), -np.ones(len(other.ends), dtype=np.int64)])
+        order = np.argsort(positions, kind='mergesort')
+        positions = positions[order]
+        depth = np.cumsum(steps[order])
+
+        return int(np.sum(np.diff(positions)[depth[:-1] == 2]))
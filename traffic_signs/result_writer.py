@@ -0,0 +1,86 @@
+import pickle
+import queue
+import threading
+
+import numpy as np
+import imageio
+
+from .results_container import ResultsContainerWriter, remove_container
+from .tracing import get_tracer
+
+
+class ResultWriter():
+    """
+    Writes the masks (png) and the window candidates (pkl) of the images in a background thread, so the detection
+    does not wait for the disk. The results wait in a bounded queue (the detection blocks only if the writer is
+    max_queue images behind) and are written in batches of up to batch_size images.
+    Call close() at the end to wait for the pending writes; errors of the writer thread are raised there.
+    With output_format='container' all the results go to a single results container (see results_container.py)
+    instead of one png and one pkl per image. Writing files removes the container of the folder, if any.
+    """
+    def __init__(self, fd, max_queue=16, batch_size=8, output_format='files'):
+        self.fd         = fd
+        self.container  = ResultsContainerWriter(fd) if output_format == 'container' else None
+        if self.container is None:
+            remove_container(fd)   # a container of a previous run would be read instead of the new files
+        self.batch_size = batch_size
+        self.queue      = queue.Queue(maxsize=max_queue)
+        self.error      = None
+        self.thread     = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, id_, pixel_candidates, window_candidates=None):
+        """
+        :param id_: image id
+        :param pixel_candidates: mask of the image
+        :param window_candidates: windows of the image (None if there is no window method)
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((id_, pixel_candidates, window_candidates))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.container is not None:
+            self.container.close()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        finished = False
+        while not finished:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                finished = True
+                batch = [result for result in batch if result is not None]
+
+            if self.error is None:
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    self.error = e
+
+    def write_batch(self, batch):
+        for id_, pixel_candidates, window_candidates in batch:
+            with get_tracer().span('write', image_id=id_):
+                self.write_result(id_, pixel_candidates, window_candidates)
+
+    def write_result(self, id_, pixel_candidates, window_candidates):
+        if self.container is not None:
+            self.container.add(id_, pixel_candidates, window_candidates)
+            return
+
+        out_mask_name = '{}/{}.png'.format(self.fd, id_)
+        imageio.imwrite(out_mask_name, np.uint8(np.round(pixel_candidates)))
+
+        if window_candidates is not None:
+            out_list_name = '{}/{}.pkl'.format(self.fd, id_)
+            with open(out_list_name, "wb") as fp:   #Pickling
+                pickle.dump(window_candidates, fp)
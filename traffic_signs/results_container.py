@@ -0,0 +1,150 @@
+import os
+import pickle
+
+import numpy as np
+import imageio
+
+
+# Results container: instead of one png and one pkl per image, the folder of a method holds
+#   masks.bin     the masks of all the images one after the other, bit-packed (or raw uint8 if not binary)
+#   index.npy     fixed-width table with one row per image (INDEX_FIELDS): id, offset and bytes of its mask in
+#                 masks.bin, shape of the mask, value of the pixels of a bit-packed mask (-1 for a raw mask), first row
+#                 and number of its windows in windows.npy (-1 if no windows were saved)
+#   windows.npy   fixed-width table with one row per window (WINDOW_FIELDS): its coordinates, which of them are integers
+#                 and how many there are
+# Both tables are memory-mapped, so reading the results of one image does not load the others. The windows are
+# exported as lists of Python ints and floats with the same values as the saved ones.
+CONTAINER_MASKS   = "masks.bin"
+CONTAINER_INDEX   = "index.npy"
+CONTAINER_WINDOWS = "windows.npy"
+
+
+def is_container(fd):
+    return os.path.exists('{}/{}'.format(fd, CONTAINER_INDEX))
+
+
+def remove_container(fd):
+    """
+    Removes the container of a folder (if any), so the results written there as files are not shadowed by it
+    """
+    for name in [CONTAINER_INDEX, CONTAINER_MASKS, CONTAINER_WINDOWS]:
+        if os.path.exists('{}/{}'.format(fd, name)):
+            os.remove('{}/{}'.format(fd, name))
+
+
+def index_dtype(id_length):
+    return np.dtype([('id', 'U{}'.format(id_length)), ('offset', np.int64), ('nbytes', np.int64),
+                     ('height', np.int32), ('width', np.int32), ('value', np.int16),
+                     ('window_offset', np.int64), ('window_count', np.int32)])
+
+
+def windows_dtype(window_length):
+    return np.dtype([('coordinates', np.float64, (window_length,)), ('integer', np.bool_, (window_length,)),
+                     ('length', np.int32)])
+
+
+class ResultsContainerWriter():
+    def __init__(self, fd):
+        self.fd            = fd
+        remove_container(fd)   # the index of a previous container would describe the new masks.bin
+        self.masks_file    = open('{}/{}'.format(fd, CONTAINER_MASKS), "wb")
+        self.offset        = 0
+        self.rows          = []   # rows of the index
+        self.windows       = []   # [tly, tlx, bry, brx, ...] of all the images
+
+    def add(self, id_, pixel_candidates, window_candidates=None):
+        """
+        :param id_: image id
+        :param pixel_candidates: mask of the image
+        :param window_candidates: list of windows [tly, tlx, bry, brx] (None if there is no window method)
+        """
+        pixel_candidates = np.uint8(np.round(pixel_candidates))
+        value = int(pixel_candidates.max(initial=0))
+        if np.count_nonzero(pixel_candidates) == np.count_nonzero(pixel_candidates == value):
+            data = np.packbits(pixel_candidates > 0)
+        else:
+            # more than one value, the mask is kept as it is
+            data, value = pixel_candidates.ravel(), -1
+        self.masks_file.write(data.tobytes())
+
+        window_offset, window_count = len(self.windows), -1
+        if window_candidates is not None:
+            window_count = len(window_candidates)
+            self.windows.extend(window_candidates)
+
+        height, width = pixel_candidates.shape
+        self.rows.append((id_, self.offset, data.size, height, width, value, window_offset, window_count))
+        self.offset += data.size
+
+    def close(self):
+        self.masks_file.close()
+
+        window_length = max([len(window) for window in self.windows] + [1])
+        windows = np.zeros(len(self.windows), dtype=windows_dtype(window_length))
+        for row, window in enumerate(self.windows):
+            windows['coordinates'][row, :len(window)] = window
+            windows['integer'][row, :len(window)] = [isinstance(coordinate, (int, np.integer)) for coordinate in window]
+            windows['length'][row] = len(window)
+        np.save('{}/{}'.format(self.fd, CONTAINER_WINDOWS), windows)
+
+        id_length = max([len(row[0]) for row in self.rows] + [1])
+        # the index is written at the end, a folder without index is not a complete container
+        np.save('{}/{}'.format(self.fd, CONTAINER_INDEX), np.array(self.rows, dtype=index_dtype(id_length)))
+
+
+class ResultsContainer():
+    """
+    Reads the results of a method saved as a container (see ResultsContainerWriter).
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.index   = np.load('{}/{}'.format(fd, CONTAINER_INDEX), mmap_mode='r')
+        self.windows = np.load('{}/{}'.format(fd, CONTAINER_WINDOWS), mmap_mode='r')
+        self.ids     = self.index['id'].tolist()
+        self.rows    = {id_: row for row, id_ in enumerate(self.ids)}
+
+        masks_name = '{}/{}'.format(fd, CONTAINER_MASKS)
+        self.packed_masks = np.memmap(masks_name, dtype=np.uint8, mode='r') if os.path.getsize(masks_name) else None
+
+    def get_mask(self, id_):
+        """
+        :return: mask of the image (uint8, same values as the saved mask)
+        """
+        _, offset, nbytes, height, width, value, _, _ = self.index[self.rows[id_]].tolist()
+        if value == -1:
+            return np.array(self.packed_masks[offset:offset + nbytes]).reshape(height, width)
+        bits = np.unpackbits(self.packed_masks[offset:offset + nbytes])[:height * width]
+        return (bits * np.uint8(value)).reshape(height, width)
+
+    def get_windows(self, id_):
+        """
+        :return: list of windows [tly, tlx, bry, brx] of the image, with the values that were saved (None if no windows
+                 were saved)
+        """
+        _, _, _, _, _, _, window_offset, window_count = self.index[self.rows[id_]].tolist()
+        if window_count == -1:
+            return None
+
+        windows = self.windows[window_offset:window_offset + window_count]
+        window_candidates = []
+        for coordinates, integer, length in zip(windows['coordinates'].tolist(), windows['integer'].tolist(),
+                                                windows['length'].tolist()):
+            window_candidates.append([int(coordinate) if is_integer else coordinate
+                                      for coordinate, is_integer in zip(coordinates[:length], integer[:length])])
+        return window_candidates
+
+    def export_legacy(self, fd):
+        """
+        Writes the results with the layout of one png and one pkl per image.
+        :param fd: output folder
+        """
+        if not os.path.exists(fd):
+            os.makedirs(fd)
+
+        for id_ in self.ids:
+            imageio.imwrite('{}/{}.png'.format(fd, id_), self.get_mask(id_))
+
+            window_candidates = self.get_windows(id_)
+            if window_candidates is not None:
+                with open('{}/{}.pkl'.format(fd, id_), "wb") as fp:   #Pickling
+                    pickle.dump(window_candidates, fp)
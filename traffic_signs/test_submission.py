@@ -4,6 +4,7 @@ import pickle
 import imageio
 from evaluation.load_annotations import load_annotations
 import evaluation.evaluation_funcs as evalf
+from results_container import ResultsContainer, is_container
 
 
 # Use this script to test your submission. Do not look at the results, as they are computed with fake annotations and masks.
@@ -50,7 +51,13 @@ methods = next(os.walk(results_dir))[1]
 for method in methods:
     print ('Method: {}\n'.format(method))
 
-    result_files = sorted(fnmatch.filter(os.listdir('{}/{}'.format(results_dir, method)), '*.png'))
+    # the results of a method are either one png and one pkl per image or a results container
+    method_dir = '{}/{}'.format(results_dir, method)
+    container  = ResultsContainer(method_dir) if is_container(method_dir) else None
+    if container is not None:
+        result_files = sorted(id_ + '.png' for id_ in container.ids)
+    else:
+        result_files = sorted(fnmatch.filter(os.listdir(method_dir), '*.png'))
 
     result_files_num = len(result_files)
 
@@ -64,7 +71,10 @@ for method in methods:
         candidate_masks_name = '{}/{}/{}'.format(results_dir, method, result_files[ii])
         print ('File: {}'.format(candidate_masks_name))
         
-        pixelCandidates = imageio.imread(candidate_masks_name)>0
+        if container is not None:
+            pixelCandidates = container.get_mask(os.path.splitext(result_files[ii])[0])>0
+        else:
+            pixelCandidates = imageio.imread(candidate_masks_name)>0
         
         # Accumulate pixel performance of the current image %%%%%%%%%%%%%%%%%
         name, ext = os.path.splitext(test_files[ii])
@@ -84,8 +94,11 @@ for method in methods:
             pkl_name      = '{}/{}/{}.pkl'.format(results_dir, method, name_r)
 
 
-            with open(pkl_name, "rb") as fp:   # Unpickling
-                windowCandidates = pickle.load(fp)
+            if container is not None:
+                windowCandidates = container.get_windows(name_r)
+            else:
+                with open(pkl_name, "rb") as fp:   # Unpickling
+                    windowCandidates = pickle.load(fp)
 
             gt_annotations_name = '{}/gt/gt.{}.txt'.format(test_dir, name)
             windowAnnotations = load_annotations(gt_annotations_name)
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+
+class Tracer():
+    """
+    Records the stages of the detection of every image as spans (name, image id, start, duration) and counters
+    (candidate regions, templates compared...), and exports them as JSONL (one event per line) or as a Chrome trace
+    (chrome://tracing, Perfetto).
+    The code to trace gets the active tracer with get_tracer(); the image id of the events is the image being
+    processed (tracer.image_id) unless it is given.
+    """
+    def __init__(self):
+        self.events   = []     # list.append is atomic, the spans of the writer thread go to the same list
+        self.image_id = None
+
+    def span(self, name, image_id=None, **args):
+        """
+        Context manager that records the time spent inside it: with tracer.span('morphology'): ...
+        """
+        return Span(self, name, self.image_id if image_id is None else image_id, args)
+
+    def count(self, name, value, image_id=None):
+        self.events.append({'type': 'count', 'name': name, 'image': self.image_id if image_id is None else image_id,
+                            'value': value, 'time': time.time(), 'pid': os.getpid(),
+                            'tid': threading.get_ident()})
+
+    def take_events(self):
+        """
+        :return: the events recorded so far, which are removed from the tracer
+        """
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events):
+        self.events.extend(events)
+
+    def write_jsonl(self, filename):
+        with open(filename, "w") as f:
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+
+    def write_chrome_trace(self, filename):
+        if self.events:
+            origin = min(event['start'] if event['type'] == 'span' else event['time'] for event in self.events)
+
+        trace_events = []
+        for event in self.events:
+            if event['type'] == 'span':
+                args = dict(event['args'], image=event['image'])
+                trace_events.append({'name': event['name'], 'cat': 'stage', 'ph': 'X',
+                                     'ts': (event['start'] - origin) * 1e6, 'dur': event['duration'] * 1e6,
+                                     'pid': event['pid'], 'tid': event['tid'], 'args': args})
+            else:
+                trace_events.append({'name': event['name'], 'cat': 'count', 'ph': 'C',
+                                     'ts': (event['time'] - origin) * 1e6,
+                                     'pid': event['pid'], 'tid': event['tid'], 'args': {'value': event['value']}})
+
+        with open(filename, "w") as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Span():
+    def __init__(self, tracer, name, image_id, args):
+        self.tracer   = tracer
+        self.name     = name
+        self.image_id = image_id
+        self.args     = args
+
+    def __enter__(self):
+        self.start = time.time()   # wall clock, so the spans of different processes can be compared
+        self.t1 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.events.append({'type': 'span', 'name': self.name, 'image': self.image_id, 'start': self.start,
+                                   'duration': time.perf_counter() - self.t1, 'pid': os.getpid(),
+                                   'tid': threading.get_ident(), 'args': self.args})
+        return False
+
+
+class NullTracer():
+    """
+    Tracer that records nothing, active when there is no tracing
+    """
+    def __init__(self):
+        self.image_id = None
+
+    def span(self, name, image_id=None, **args):
+        return NULL_SPAN
+
+    def count(self, name, value, image_id=None):
+        pass
+
+    def take_events(self):
+        return []
+
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+active_tracer = NullTracer()
+
+
+def get_tracer():
+    return active_tracer
+
+
+def set_tracer(tracer):
+    """
+    Sets the active tracer of the process (a NullTracer if tracer is None)
+    :return: the previous tracer
+    """
+    global active_tracer
+    previous, active_tracer = active_tracer, tracer if tracer is not None else NullTracer()
+    return previous
@@ -10,6 +10,8 @@ Options:
 
 
 import fnmatch
+import inspect
+import multiprocessing
 import os
 import sys
 import pickle
@@ -23,13 +25,18 @@ import cv2
 from .candidate_generation_pixel  import candidate_generation_pixel
 from .candidate_generation_window import candidate_generation_window
 from .evaluation.load_annotations import load_annotations
+from .result_writer import ResultWriter
+from .tracing import Tracer, get_tracer, set_tracer
 from .evaluation.evaluation_funcs import performance_accumulation_pixel, performance_accumulation_window
+from .evaluation.evaluation_funcs import performance_accumulation_pixel_rle
+from .evaluation.evaluation_funcs import performance_accumulation_pixel_packed
 from .evaluation.evaluation_funcs import performance_evaluation_pixel, performance_evaluation_window
 
 
 def traffic_sign_detection(annotations_available, directory, split_instances, output_dir, 
                            pixel_method_name, pixel_method, 
-                           window_method_name, window_method, show_progress=False):
+                           window_method_name, window_method, show_progress=False, workers=1, write_results=True,
+                           output_format='files', trace_prefix=None):
 
     """
     We have modified this code so it either segments the images in the validation split (and returns the metrics) or
@@ -37,12 +44,23 @@ def traffic_sign_detection(annotations_available, directory, split_instances, ou
     From this function the function "candidate_generation_pixel" is called and the images are segmented. Then we call
     the function "morph_transformation", which performs morphological operations over the mask.
 
+    The images go through a pipeline of generators (read -> segment -> detect) and the results are written by a
+    background thread (ResultWriter), so the disk writes are not in the compute path.
+
     :param directory: train root directory eg ./train/
     :param split_instances: list with the split instances.
     :param output_dir: output directory
     :param pixel_method: colorspace segmentation method. Either hsv or normrgb.
     :param window_method: None because none
     :param show_progress: If true shows the progress.
+    :param workers: number of processes. With more than one the images are processed in a process pool, every worker
+                    receives its own copy of the model once. The metrics are the same as with one process.
+    :param write_results: if False nothing is written (only evaluation)
+    :param output_format: 'files' (one png and one pkl per image) or 'container' (all the results of the split in one
+                          results container, see results_container.py)
+    :param trace_prefix: if given, the time of every stage of every image (decode, segmentation, morphology, CCL,
+                         window method, write, metrics) and the counters of the model are written to
+                         trace_prefix.jsonl and trace_prefix.trace.json (Chrome trace)
     :return:
     """
     pixel_precision   = None
@@ -68,62 +86,207 @@ def traffic_sign_detection(annotations_available, directory, split_instances, ou
 
     random.shuffle(split_instances)
 
-    for instance in split_instances:
-        id_ = instance.img_id
+    tracer = None
+    if trace_prefix is not None:
+        tracer = Tracer()
+        previous_tracer = set_tracer(tracer)
+
+    writer = None
+    if write_results:
+        fd = '{}/{}_{}'.format(output_dir, pixel_method_name, window_method_name)
+        if not os.path.exists(fd):
+            os.makedirs(fd)
+        writer = ResultWriter(fd, output_format=output_format)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=worker_methods(pixel_method, window_method) + (tracer is not None,))
+        # the instances are pickled without their memory-mapped views (Instance.__getstate__), every worker maps
+        # them again from the store of the split
+        tasks = [(instance, directory, annotations_available, write_results, show_progress)
+                 for instance in split_instances]
+        # imap keeps the order of the split, so the accumulation is the same as in the serial loop
+        results = collect_worker_events(
+            pool.imap(process_instance_worker, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        pool = None
+        images     = read_images(split_instances, directory, show_progress)
+        detections = detect(images, pixel_method, window_method, write_results)
+        results    = evaluate_detections(detections, directory, annotations_available, window_method != None)
+
+    try:
+        for id_, written_mask, window_candidates, local_counts in results:
+            if writer is not None:
+                writer.write(id_, written_mask, window_candidates)
+
+            if annotations_available:
+                [localPixelTP, localPixelFP, localPixelFN, localPixelTN, localWindowTP, localWindowFN, localWindowFP] = \
+                    local_counts
+
+                # Accumulate pixel performance of the current image #################
+                pixelTP = pixelTP + localPixelTP
+                pixelFP = pixelFP + localPixelFP
+                pixelFN = pixelFN + localPixelFN
+                pixelTN = pixelTN + localPixelTN
+
+                [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = performance_evaluation_pixel(pixelTP, pixelFP, pixelFN, pixelTN)
+
+                if window_method != None:
+                    # Accumulate object performance of the current image ################
+                    windowTP = windowTP + localWindowTP
+                    windowFN = windowFN + localWindowFN
+                    windowFP = windowFP + localWindowFP
+
+
+                    # Plot performance evaluation
+                    [window_precision, window_sensitivity, window_accuracy] = performance_evaluation_window(windowTP, windowFN, windowFP)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if writer is not None:
+            writer.close()
+        if tracer is not None:
+            set_tracer(previous_tracer)
+            tracer.write_jsonl(trace_prefix + '.jsonl')
+            tracer.write_chrome_trace(trace_prefix + '.trace.json')
+
+    return [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity, window_precision, window_sensitivity, window_accuracy]
+
 
-        # Read file
+def read_image(instance, directory, show_progress=False):
+    id_ = instance.img_id
+
+    # Read file (or take the decoded view if the split has been materialized)
+    if instance.img_view is not None:
+        image = instance.img_view
+    else:
         image = cv2.imread('{}/{}'.format(directory, id_ + ".jpg"))
 
-        if show_progress:
-            print('{}/{}'.format(directory,id_+".jpg"))
+    if show_progress:
+        print('{}/{}'.format(directory,id_+".jpg"))
 
-        # Candidate Generation (pixel) ######################################
-        #pixel_candidates = candidate_generation_pixel(image, pixel_method)
-        pixel_candidates = pixel_method(image)
+    return image
 
-        fd = '{}/{}_{}'.format(output_dir, pixel_method_name, window_method_name)
-        if not os.path.exists(fd):
-            os.makedirs(fd)
 
-        out_mask_name = '{}/{}.png'.format(fd, id_)
-        imageio.imwrite (out_mask_name, np.uint8(np.round(pixel_candidates)))
+def read_images(split_instances, directory, show_progress=False):
+    for instance in split_instances:
+        tracer = get_tracer()
+        tracer.image_id = instance.img_id   # the following stages belong to this image
+        with tracer.span('decode'):
+            image = read_image(instance, directory, show_progress)
+        yield instance, image
 
 
-        if window_method != None:
-            #window_candidates = candidate_generation_window(image, pixel_candidates, window_method)
-            window_candidates = window_method(image, pixel_candidates)
-            out_list_name = '{}/{}.pkl'.format(fd, id_)
+def detect(images, pixel_method, window_method, write_results=True):
+    """
+    Segments the images and finds their windows.
+    :return: generator of (instance, pixel_candidates, mask to write, window_candidates)
+    """
+    tracer = get_tracer()
+    for instance, image in images:
+        # Candidate Generation (pixel) ######################################
+        #pixel_candidates = candidate_generation_pixel(image, pixel_method)
+        with tracer.span('pixel_method'):
+            pixel_candidates = pixel_method(image)
 
-            with open(out_list_name, "wb") as fp:   #Pickling
-                pickle.dump(window_candidates, fp)
+        # the window method can modify the mask, the saved mask is the output of the pixel method
+        written_mask = np.copy(pixel_candidates) if write_results and window_method != None else pixel_candidates
 
+        window_candidates = None
+        if window_method != None:
+            #window_candidates = candidate_generation_window(image, pixel_candidates, window_method)
+            with tracer.span('window_method'):
+                window_candidates = window_method(image, pixel_candidates)
 
-        if annotations_available:
-            # Accumulate pixel performance of the current image #################
-            pixel_annotation = imageio.imread('{}/mask/mask.{}.png'.format(directory,id_)) > 0
+        yield instance, pixel_candidates, written_mask, window_candidates
 
-            [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = performance_accumulation_pixel(pixel_candidates, pixel_annotation)
-            pixelTP = pixelTP + localPixelTP
-            pixelFP = pixelFP + localPixelFP
-            pixelFN = pixelFN + localPixelFN
-            pixelTN = pixelTN + localPixelTN
 
-            [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity] = performance_evaluation_pixel(pixelTP, pixelFP, pixelFN, pixelTN)
+def evaluate_detections(detections, directory, annotations_available, window_evaluation):
+    """
+    Computes the local metrics of every image.
+    :return: generator of (id, mask to write, window_candidates, local metrics). The local metrics are
+             [pixelTP, pixelFP, pixelFN, pixelTN, windowTP, windowFN, windowFP] (None without annotations)
+    """
+    tracer = get_tracer()
+    for instance, pixel_candidates, written_mask, window_candidates in detections:
+        id_ = instance.img_id
 
-            if window_method != None:
-                # Accumulate object performance of the current image ################
+        if not annotations_available:
+            yield id_, written_mask, window_candidates, None
+            continue
+
+        with tracer.span('metrics'):
+            if instance.msk_rle is not None:
+                # run-length encoded ground truth (Data_handler.encode_masks_rle)
+                [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = performance_accumulation_pixel_rle(pixel_candidates, instance.msk_rle)
+            elif instance.msk_packed is not None:
+                # bit-packed ground truth (Data_handler.pack_masks)
+                [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = performance_accumulation_pixel_packed(pixel_candidates, instance.msk_packed)
+            else:
+                if instance.msk_view is not None:
+                    pixel_annotation = instance.msk_view
+                else:
+                    pixel_annotation = imageio.imread('{}/mask/mask.{}.png'.format(directory,id_)) > 0
+                [localPixelTP, localPixelFP, localPixelFN, localPixelTN] = performance_accumulation_pixel(pixel_candidates, pixel_annotation)
+
+            localWindowTP, localWindowFN, localWindowFP = 0, 0, 0
+            if window_evaluation:
                 window_annotationss = load_annotations('{}/gt/gt.{}.txt'.format(directory, id_))
                 [localWindowTP, localWindowFN, localWindowFP] = performance_accumulation_window(window_candidates, window_annotationss)
 
-                windowTP = windowTP + localWindowTP
-                windowFN = windowFN + localWindowFN
-                windowFP = windowFP + localWindowFP
+        yield id_, written_mask, window_candidates, \
+            [localPixelTP, localPixelFP, localPixelFN, localPixelTN, localWindowTP, localWindowFN, localWindowFP]
 
 
-                # Plot performance evaluation
-                [window_precision, window_sensitivity, window_accuracy] = performance_evaluation_window(windowTP, windowFN, windowFP)
+# methods of the model of the current worker process, set once by init_worker
+worker_pixel_method  = None
+worker_window_method = None
 
-    return [pixel_precision, pixel_accuracy, pixel_specificity, pixel_sensitivity, window_precision, window_sensitivity, window_accuracy]
+
+def worker_methods(pixel_method, window_method):
+    """
+    Arguments of init_worker. If both methods are bound to the same model, the model is sent once with the names of
+    the methods, so every worker has one copy of the model (and of its caches) for both methods.
+    :return: (model, pixel_method, window_method), model is None if the methods are sent as they are
+    """
+    model = pixel_method.__self__ if inspect.ismethod(pixel_method) else None
+    if model is not None and (window_method is None or getattr(window_method, '__self__', None) is model):
+        return model, pixel_method.__name__, window_method.__name__ if window_method is not None else None
+    return None, pixel_method, window_method
+
+
+def init_worker(model, pixel_method, window_method, tracing=False):
+    global worker_pixel_method, worker_window_method
+    if model is not None:
+        pixel_method  = getattr(model, pixel_method)
+        window_method = getattr(model, window_method) if window_method is not None else None
+    worker_pixel_method  = pixel_method
+    worker_window_method = window_method
+    if tracing:
+        set_tracer(Tracer())
+
+
+def process_instance_worker(task):
+    # the whole pipeline for one image, the results are written by the main process
+    instance, directory, annotations_available, write_results, show_progress = task
+    images     = read_images([instance], directory, show_progress)
+    detections = detect(images, worker_pixel_method, worker_window_method, write_results)
+    id_, written_mask, window_candidates, local_counts = next(
+        evaluate_detections(detections, directory, annotations_available, worker_window_method != None))
+
+    if not write_results:
+        written_mask, window_candidates = None, None
+    # the events of the image go back to the main process with its results
+    return id_, written_mask, window_candidates, local_counts, get_tracer().take_events()
+
+
+def collect_worker_events(results):
+    # moves the trace events of the workers to the tracer of the main process
+    for id_, written_mask, window_candidates, local_counts, events in results:
+        if events:
+            get_tracer().extend(events)
+        yield id_, written_mask, window_candidates, local_counts
 
 
 if __name__ == '__main__':